@@ -3,12 +3,83 @@ Logging configuration for the File Vault application.
 
 This module configures structured logging for the application,
 with appropriate log levels for development and production.
+``queue_handler`` is the factory settings.LOGGING uses so request threads
+only enqueue records while a background thread does the console I/O;
+``PeriodicMemoryHandler`` batches those writes.
 """
 
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
+import threading
 from django.conf import settings
 
+# Background listener that performs the actual log I/O; kept at module level
+# so it is not garbage collected and can be stopped at interpreter exit.
+_queue_listener = None
+
+
+class PeriodicMemoryHandler(logging.handlers.MemoryHandler):
+    """
+    MemoryHandler that also flushes its buffer every ``flush_interval`` seconds.
+    
+    Bursts are written to the target in batches of up to ``capacity`` records,
+    while a daemon thread keeps records from quiet periods appearing promptly.
+    """
+
+    def __init__(self, capacity, flushLevel=logging.ERROR, target=None, flush_interval=1.0):
+        super().__init__(capacity, flushLevel=flushLevel, target=target)
+        self._stopped = threading.Event()
+        threading.Thread(
+            target=self._flush_periodically, args=(flush_interval,), name='log-flush', daemon=True
+        ).start()
+
+    def _flush_periodically(self, interval):
+        while not self._stopped.wait(interval):
+            self.flush()
+
+    def close(self):
+        self._stopped.set()
+        super().close()
+
+
+def queue_handler(target):
+    """
+    Build a QueueHandler whose records are written to ``target`` by a QueueListener.
+    
+    Used as a ``()`` factory in settings.LOGGING, with ``target`` given as
+    ``cfg://handlers.<name>``. dictConfig configures handlers in name order,
+    so the target's name must sort before the queue handler's.
+    
+    Args:
+        target: The configured handler that does the actual writing
+        
+    Returns:
+        logging.handlers.QueueHandler: Handler that only enqueues records
+        
+    Raises:
+        TypeError: If ``target`` hasn't been configured as a handler yet
+    """
+    if not isinstance(target, logging.Handler):
+        raise TypeError("queue_handler target must be configured before the queue handler")
+    global _queue_listener
+    if _queue_listener is not None:
+        # Logging reconfigured: drain and stop the previous listener first
+        _queue_listener.stop()
+    log_queue = queue.SimpleQueue()
+    _queue_listener = logging.handlers.QueueListener(log_queue, target, respect_handler_level=True)
+    _queue_listener.start()
+    return logging.handlers.QueueHandler(log_queue)
+
+
+@atexit.register
+def _stop_queue_listener():
+    """Write out queued records before the interpreter exits."""
+    if _queue_listener is not None:
+        _queue_listener.stop()
+
 
 def configure_logging():
     """
@@ -126,6 +126,10 @@ USE_TZ = True
 STATIC_URL = "/static/"
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+# "/" is answered by core.views.spa_index, which caches index.html in memory
+# and serves it with an ETag. WHITENOISE_ROOT is deliberately unset: pointing
+# it at STATIC_ROOT would expose every collected file (admin/DRF assets, the
+# staticfiles.json manifest) at the site root as well as under /static/.
 
 # Media files
 MEDIA_URL = '/media/'
@@ -141,6 +145,10 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny'
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'drf_orjson_renderer.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     'DEFAULT_PARSER_CLASSES': [
         'rest_framework.parsers.JSONParser',
         'rest_framework.parsers.MultiPartParser',
@@ -163,6 +171,51 @@ FILE_VAULT_STORAGE_QUOTA_MB = int(os.environ.get('FILE_VAULT_STORAGE_QUOTA_MB',
 FILE_VAULT_RATE_LIMIT_CALLS = int(os.environ.get('FILE_VAULT_RATE_LIMIT_CALLS', 2))
 FILE_VAULT_RATE_LIMIT_WINDOW = int(os.environ.get('FILE_VAULT_RATE_LIMIT_WINDOW', 1))
 FILE_VAULT_ENABLE_FTS = os.environ.get('FILE_VAULT_ENABLE_FTS', 'False') == 'True'
+# Content hash used for deduplication: 'sha256' or 'blake3' (pip install blake3).
+# Files stored under one algorithm won't deduplicate against uploads under the other.
+FILE_VAULT_HASH_ALGORITHM = os.environ.get('FILE_VAULT_HASH_ALGORITHM', 'sha256')
+
+# Encode list pages to JSON row by row instead of rendering the whole page at
+# once. Only JSON requests stream; the browsable API renders as usual.
+FILE_VAULT_STREAM_LIST_RESPONSES = os.environ.get('FILE_VAULT_STREAM_LIST_RESPONSES', 'False') == 'True'
+
+# With Redis, pipeline rate limit checks that arrive within ~1ms of each other
+# in the same process. Saves round trips under load but adds up to 1ms per
+# check, so it is off by default.
+FILE_VAULT_THROTTLE_BATCHING = os.environ.get('FILE_VAULT_THROTTLE_BATCHING', 'False') == 'True'
+
+# Caches are per-process unless REDIS_URL is set (pip install redis), in which
+# case every worker shares the same response caches and rate limit windows.
+# Throttling gets its own alias so response caching can't evict its state.
+# With the LocMem fallback, the per-user files version behind list ETags and
+# the file types cache is also per process: with more than one worker, a
+# worker that didn't handle an upload or delete keeps serving its old version
+# (stale 304s and file types) until its entries expire. Set REDIS_URL for
+# multi-worker deployments.
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+        'throttle': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': 'throttle',
+            'OPTIONS': {'max_connections': 64},
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'throttle': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'throttle',
+        },
+    }
 
 # CORS Configuration for frontend integration
 CORS_ALLOWED_ORIGINS = [
@@ -209,24 +262,40 @@ LOGGING = {
             'class': 'logging.StreamHandler',
             'formatter': 'verbose',
         },
+        # Buffers up to 512 records per console write; ERROR and above, and a
+        # flush every second, write the buffer out sooner
+        'console_buffer': {
+            'class': 'core.logging_config.PeriodicMemoryHandler',
+            'capacity': 512,
+            'flushLevel': 'ext://logging.ERROR',
+            'flush_interval': 1.0,
+            'target': 'console',
+        },
+        # Request threads only enqueue records; a QueueListener thread hands
+        # them to 'console_buffer' (which must sort before 'queue', see
+        # queue_handler)
+        'queue': {
+            '()': 'core.logging_config.queue_handler',
+            'target': 'cfg://handlers.console_buffer',
+        },
     },
     'root': {
-        'handlers': ['console'],
+        'handlers': ['queue'],
         'level': 'DEBUG' if DEBUG else 'INFO',
     },
     'loggers': {
         'django': {
-            'handlers': ['console'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': False,
         },
         'django.db.backends': {
-            'handlers': ['console'],
+            'handlers': ['queue'],
             'level': 'DEBUG' if DEBUG else 'WARNING',
             'propagate': False,
         },
         'files': {
-            'handlers': ['console'],
+            'handlers': ['queue'],
             'level': 'DEBUG' if DEBUG else 'INFO',
             'propagate': False,
         },
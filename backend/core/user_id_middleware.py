@@ -2,15 +2,26 @@
 User ID middleware for enforcing UserId header on API requests.
 
 This middleware validates that all API requests include a UserId header
-and attaches it to the request object for use in views and services.
+and attaches it to the request object (and files.utils.current_user_id)
+for use in views and services.
 """
 
+import json
 import logging
-from django.http import JsonResponse
+from django.http import HttpResponse
 from files.constants import USER_ID_HEADER, ERROR_USER_ID_REQUIRED
+from files.utils import current_user_id
 
 logger = logging.getLogger(__name__)
 
+API_PREFIX = '/api/'
+
+# WSGI META key for the UserId header (what request.headers resolves it to)
+_USER_ID_META_KEY = 'HTTP_' + USER_ID_HEADER.upper().replace('-', '_')
+
+# Error body is constant, so encode it once instead of per rejected request
+_USER_ID_REQUIRED_BODY = json.dumps({"detail": ERROR_USER_ID_REQUIRED}).encode()
+
 
 class UserIdMiddleware:
     """
@@ -40,16 +51,22 @@ class UserIdMiddleware:
             HTTP response (either error response or next middleware's response)
         """
         # Only enforce for API routes; allow frontend/static access without header
-        if request.path.startswith('/api/'):
-            user_id = request.headers.get(USER_ID_HEADER)
+        if request.path_info.startswith(API_PREFIX):
+            user_id = request.META.get(_USER_ID_META_KEY)
             if not user_id:
-                logger.warning(f"Missing UserId header for API request: {request.path}")
-                return JsonResponse(
-                    {"detail": ERROR_USER_ID_REQUIRED}, 
+                logger.warning("Missing UserId header for API request: %s", request.path_info)
+                return HttpResponse(
+                    _USER_ID_REQUIRED_BODY,
+                    content_type='application/json',
                     status=400
                 )
             request.user_id = user_id
-            logger.debug(f"UserId header validated: user_id={user_id}, path={request.path}")
+            logger.debug("UserId header validated: user_id=%s, path=%s", user_id, request.path_info)
+            token = current_user_id.set(user_id)
+            try:
+                return self.get_response(request)
+            finally:
+                current_user_id.reset(token)
         return self.get_response(request)
 
 
@@ -1,14 +1,37 @@
+import hashlib
 import os
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseNotFound
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseNotModified
+
+# Browsers may reuse index.html for this long before revalidating with the ETag
+SPA_INDEX_MAX_AGE = 60
+
+# (content, etag, mtime) of the last index.html read, reloaded when the file changes
+_INDEX_CACHE = None
+
+
+def _load_index(index_path):
+    global _INDEX_CACHE
+    mtime = os.stat(index_path).st_mtime_ns
+    if _INDEX_CACHE is None or _INDEX_CACHE[2] != mtime:
+        with open(index_path, 'rb') as f:
+            content = f.read()
+        etag = '"%s"' % hashlib.md5(content).hexdigest()
+        _INDEX_CACHE = (content, etag, mtime)
+    return _INDEX_CACHE
 
 
 def spa_index(request):
     index_path = os.path.join(settings.STATIC_ROOT, 'index.html')
-    if not os.path.exists(index_path):
+    try:
+        content, etag, _ = _load_index(index_path)
+    except FileNotFoundError:
         return HttpResponseNotFound('Frontend not built. Run npm run build in frontend/.')
-    with open(index_path, 'rb') as f:
-        content = f.read()
-    return HttpResponse(content, content_type='text/html')
-
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type='text/html')
+    response['ETag'] = etag
+    response['Cache-Control'] = f'public, max-age={SPA_INDEX_MAX_AGE}'
+    return response
 
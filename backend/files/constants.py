@@ -21,19 +21,38 @@ ERROR_STORAGE_QUOTA_EXCEEDED = "Storage Quota Exceeded"
 ERROR_CANNOT_DELETE_WITH_REFERENCES = "Cannot delete original file with active references"
 
 # File Upload Settings
-SHA256_HASH_LENGTH = 64  # SHA-256 hex digest length
+HASH_HEX_LENGTH = 64  # Hex digest length (SHA-256 and BLAKE3 both produce 64)
+HASH_ALGORITHM_SHA256 = "sha256"
+HASH_ALGORITHM_BLAKE3 = "blake3"
+DEFAULT_HASH_ALGORITHM = HASH_ALGORITHM_SHA256
+HASH_READ_BLOCK_SIZE = 1024 * 1024  # 1 MiB read size when hashing without file_digest
+HASH_POOL_WORKERS = 4  # Threads hashing disk-backed uploads alongside the copy
 MAX_FILENAME_LENGTH = 255
 MAX_FILE_TYPE_LENGTH = 100
+DEDUP_CACHE_MAX_ENTRIES = 10_000  # Per-process file_hash -> original LRU size
 
 # Rate Limit Cache Key Prefix
 RATE_LIMIT_CACHE_PREFIX = "throttle_user_id"
+THROTTLE_CACHE_ALIAS = "throttle"  # CACHES alias holding rate limit windows
+THROTTLE_WINDOW_BUCKETS = 10  # Counters a Redis rate limit window is split into
+THROTTLE_BATCH_MAX_SIZE = 32  # Most throttle checks sent in one Redis pipeline
+THROTTLE_BATCH_WINDOW_SECONDS = 0.001  # How long a batch waits for more checks
+THROTTLE_DENY_CACHE_SECONDS = 0.1  # Throttled users are rejected locally this long
+THROTTLE_DENY_CACHE_MAX_SIZE = 1024  # Entries before expired denials are purged
+
+# Per-user response caches, invalidated by the views after an upload or delete
+STATS_CACHE_PREFIX = "stats"
+STATS_CACHE_TTL_SECONDS = 30
+FILE_TYPES_CACHE_PREFIX = "file_types"
+FILE_TYPES_CACHE_TTL_SECONDS = 600
+# Per-user counter bumped on every upload/delete; versions stats, file_types and ETags
+FILES_VERSION_PREFIX = "files_ver"
 
 # Database Index Names (for reference)
-INDEX_USER_ID = "idx_user_id"
 INDEX_USER_UPLOADED = "idx_user_uploaded"
 INDEX_USER_FILE_TYPE = "idx_user_file_type"
 INDEX_USER_SIZE = "idx_user_size"
 INDEX_USER_FILENAME_SEARCH = "idx_user_filename_search"
 INDEX_USER_IS_REFERENCE = "idx_user_is_reference"
-INDEX_HASH_IS_REFERENCE = "idx_hash_is_reference"
+INDEX_HASH_ORIG_ONLY = "idx_hash_orig_only"
 
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-14 10:38
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_reference_count(apps, schema_editor):
+    File = apps.get_model('files', 'File')
+    counts = (
+        File.objects.filter(original_file__isnull=False)
+        .values('original_file')
+        .annotate(c=Count('*'))
+    )
+    for row in counts:
+        File.objects.filter(pk=row['original_file']).update(reference_count=row['c'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='reference_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_reference_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2.30 on 2026-10-14 10:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0002_file_reference_count'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='file',
+            name='idx_user_id',
+        ),
+        migrations.RemoveIndex(
+            model_name='file',
+            name='idx_original_filename',
+        ),
+        migrations.RemoveIndex(
+            model_name='file',
+            name='idx_file_hash',
+        ),
+        migrations.AlterField(
+            model_name='file',
+            name='file_hash',
+            field=models.CharField(max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='file',
+            name='file_type',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='file',
+            name='is_reference',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='file',
+            name='original_filename',
+            field=models.CharField(max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='file',
+            name='size',
+            field=models.IntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='file',
+            name='uploaded_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AlterField(
+            model_name='file',
+            name='user_id',
+            field=models.CharField(max_length=255),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-14 10:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0003_prune_redundant_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='file',
+            name='idx_hash_is_reference',
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(condition=models.Q(('is_reference', False)), fields=['file_hash'], name='idx_hash_orig_only'),
+        ),
+    ]
@@ -1,25 +1,25 @@
 from django.db import models
+from django.db.models import Q
 import uuid
 import os
 
 
 def file_upload_path(instance, filename):
-    ext = filename.split('.')[-1] if '.' in filename else ''
-    name = f"{uuid.uuid4()}"
-    filename = f"{name}.{ext}" if ext else name
-    return os.path.join('uploads', filename)
+    ext = os.path.splitext(filename)[1]
+    name = uuid.uuid4().hex
+    return os.path.join('uploads', name + ext if ext != '.' else name)
 
 
 class File(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     file = models.FileField(upload_to=file_upload_path, null=True, blank=True)
-    original_filename = models.CharField(max_length=255, db_index=True)
-    file_type = models.CharField(max_length=100, db_index=True)
-    size = models.IntegerField(db_index=True)
-    uploaded_at = models.DateTimeField(auto_now_add=True, db_index=True)
-    user_id = models.CharField(max_length=255, db_index=True)
-    file_hash = models.CharField(max_length=64, db_index=True)
-    is_reference = models.BooleanField(default=False, db_index=True)
+    original_filename = models.CharField(max_length=255)
+    file_type = models.CharField(max_length=100)
+    size = models.IntegerField()
+    uploaded_at = models.DateTimeField(auto_now_add=True)
+    user_id = models.CharField(max_length=255)
+    file_hash = models.CharField(max_length=64)
+    is_reference = models.BooleanField(default=False)
     original_file = models.ForeignKey(
         "self",
         null=True,
@@ -28,14 +28,14 @@ class File(models.Model):
         related_name="references",
         related_query_name="reference",
     )
+    # Number of reference rows pointing at this original, maintained by the
+    # upload and delete services so list queries don't have to count them
+    reference_count = models.IntegerField(default=0)
 
     class Meta:
+        # No single-column indexes: every query is scoped by user_id (a left prefix
+        # of the composites below) or looks up file_hash (idx_hash_orig_only)
         indexes = [
-            # Single column indexes (already have db_index=True, but explicit for clarity)
-            models.Index(fields=["user_id"], name="idx_user_id"),
-            models.Index(fields=["original_filename"], name="idx_original_filename"),
-            models.Index(fields=["file_hash"], name="idx_file_hash"),
-            
             # Composite indexes for common filter combinations
             models.Index(fields=["user_id", "uploaded_at"], name="idx_user_uploaded"),
             models.Index(fields=["user_id", "file_type"], name="idx_user_file_type"),
@@ -51,8 +51,13 @@ class File(models.Model):
             models.Index(fields=["user_id", "file_type", "uploaded_at"], name="idx_user_type_date"),
             models.Index(fields=["user_id", "size", "uploaded_at"], name="idx_user_size_date"),
             
-            # Index for deduplication lookups (hash + is_reference)
-            models.Index(fields=["file_hash", "is_reference"], name="idx_hash_is_reference"),
+            # Partial index for deduplication lookups: only originals are ever
+            # probed by hash, so reference rows are left out of the index
+            models.Index(
+                fields=["file_hash"],
+                name="idx_hash_orig_only",
+                condition=Q(is_reference=False),
+            ),
         ]
 
     def __str__(self):
@@ -0,0 +1,31 @@
+"""
+Permission classes for the File Vault API.
+
+UserIdMiddleware already rejects API requests without a UserId header; this
+permission enforces the same requirement inside DRF so every FileViewSet
+action can rely on ``request.user_id`` being set.
+"""
+
+from rest_framework.permissions import BasePermission
+from files.constants import ERROR_USER_ID_REQUIRED
+from files.utils import get_request_user_id
+
+
+class HasUserId(BasePermission):
+    """
+    Allow the request only if a user ID has been attached to it.
+    """
+    message = ERROR_USER_ID_REQUIRED
+
+    def has_permission(self, request, view) -> bool:
+        """
+        Check that the request carries a user ID.
+
+        Args:
+            request: The HTTP request object
+            view: The view being accessed
+
+        Returns:
+            True if the request's user ID is set and non-empty
+        """
+        return bool(get_request_user_id(request))
@@ -1,25 +1,117 @@
+import copy
+from django.db import models
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 from .models import File
 
+# FileSerializer's fields, also the columns the list endpoint fetches with
+# .values() ('original_file' comes back as the related id)
+LIST_VALUE_FIELDS = (
+    'id',
+    'file',
+    'original_filename',
+    'file_type',
+    'size',
+    'uploaded_at',
+    'user_id',
+    'file_hash',
+    'is_reference',
+    'original_file',
+    'reference_count',
+)
+
+
+class FileListSerializer(serializers.ListSerializer):
+    """
+    List serializer that builds each row straight from model attributes.
+
+    Skips DRF's per-field dispatch on list endpoints. Only ``file`` and
+    ``uploaded_at`` go through their fields so download URLs and datetime
+    formatting stay identical to FileSerializer. Also accepts the dicts of a
+    ``.values(*LIST_VALUE_FIELDS)`` queryset, so no model instances are built.
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+        rows = list(iterable)
+        if rows and isinstance(rows[0], dict):
+            return list(self.iter_values_representation(rows))
+        fields = self.child.fields
+        file_field = fields['file']
+        uploaded_at_field = fields['uploaded_at']
+        return [
+            {
+                'id': str(obj.id),
+                'file': file_field.to_representation(obj.file),
+                'original_filename': obj.original_filename,
+                'file_type': obj.file_type,
+                'size': obj.size,
+                'uploaded_at': uploaded_at_field.to_representation(obj.uploaded_at),
+                'user_id': obj.user_id,
+                'file_hash': obj.file_hash,
+                'is_reference': obj.is_reference,
+                'original_file': obj.original_file_id,
+                'reference_count': obj.reference_count,
+            }
+            for obj in rows
+        ]
+
+    def iter_values_representation(self, rows):
+        """
+        Yield the representation of each ``.values(*LIST_VALUE_FIELDS)`` row.
+        
+        Lets a streaming response encode rows one at a time instead of
+        building the whole page of dicts first.
+        """
+        fields = self.child.fields
+        file_field = fields['file']
+        uploaded_at_field = fields['uploaded_at']
+        # Same output as FileField.to_representation, from the stored name
+        storage = File._meta.get_field('file').storage
+        use_url = getattr(file_field, 'use_url', api_settings.UPLOADED_FILES_USE_URL)
+        request = file_field.context.get('request')
+
+        def file_repr(name):
+            if not name:
+                return None
+            if not use_url:
+                return name
+            url = storage.url(name)
+            return request.build_absolute_uri(url) if request is not None else url
+
+        for row in rows:
+            yield {
+                'id': str(row['id']),
+                'file': file_repr(row['file']),
+                'original_filename': row['original_filename'],
+                'file_type': row['file_type'],
+                'size': row['size'],
+                'uploaded_at': uploaded_at_field.to_representation(row['uploaded_at']),
+                'user_id': row['user_id'],
+                'file_hash': row['file_hash'],
+                'is_reference': row['is_reference'],
+                'original_file': row['original_file'],
+                'reference_count': row['reference_count'],
+            }
+
 
 class FileSerializer(serializers.ModelSerializer):
-    reference_count = serializers.IntegerField(read_only=True)
     original_file = serializers.PrimaryKeyRelatedField(read_only=True)
-    # File field will automatically serialize to a URL for download
+    # File field will automatically serialize to a URL for download;
+    # file_hash is the content hash (SHA-256 by default) used for deduplication
+
+    # Fields built from Meta on first use; later instances get a deep copy
+    # instead of repeating ModelSerializer's model introspection
+    _fields_template = None
 
     class Meta:
         model = File
-        fields = [
-            'id',
-            'file',  # This provides the download URL
-            'original_filename',
-            'file_type',
-            'size',
-            'uploaded_at',
-            'user_id',
-            'file_hash',  # SHA-256 hash for deduplication
-            'is_reference',
-            'original_file',
-            'reference_count',
-        ]
-        read_only_fields = ['id', 'uploaded_at', 'is_reference', 'original_file', 'reference_count', 'user_id', 'file_hash']
\ No newline at end of file
+        list_serializer_class = FileListSerializer
+        fields = LIST_VALUE_FIELDS
+        read_only_fields = ['id', 'uploaded_at', 'is_reference', 'original_file', 'reference_count', 'user_id', 'file_hash']
+
+    def get_fields(self):
+        cls = type(self)
+        if cls.__dict__.get('_fields_template') is None:
+            cls._fields_template = super().get_fields()
+        return copy.deepcopy(cls._fields_template)
@@ -8,9 +8,11 @@ physical file removal, and user statistics updates.
 import logging
 from typing import Optional
 from django.db import transaction
+from django.db.models import F
 from django.core.exceptions import ObjectDoesNotExist
 from rest_framework.exceptions import APIException, NotFound
-from files.models import File, UserStats
+from files.models import File
+from files.services.stats_service import bump_user_stats
 from files.constants import ERROR_CANNOT_DELETE_WITH_REFERENCES
 from files.utils import validate_user_id
 
@@ -26,8 +28,25 @@ class ConflictError(APIException):
         super().__init__(self.default_detail)
 
 
+def _delete_stored_file(storage_file, file_id: str) -> None:
+    """
+    Delete a file from storage, logging rather than raising on failure.
+    
+    Args:
+        storage_file: The FieldFile of the deleted File record
+        file_id: The UUID of the deleted file (for logging)
+    """
+    try:
+        storage_file.delete(save=False)
+        logger.debug("Physical file deleted for file_id=%s", file_id)
+    except Exception as e:
+        # Ignore physical delete failures to keep API responsive
+        # File record is already gone, so this is non-critical
+        logger.warning("Failed to delete physical file for file_id=%s: %s", file_id, e)
+
+
 @transaction.atomic
-def delete_file(user_id: str, file_id: str) -> None:
+def delete_file(user_id: str, file_id: str) -> Optional[str]:
     """
     Delete a file record and update user statistics.
     
@@ -38,13 +57,17 @@ def delete_file(user_id: str, file_id: str) -> None:
     For original files:
     - Checks if any references exist (across all users)
     - If references exist, raises ConflictError
-    - Otherwise, deletes physical file and record
+    - Otherwise, deletes the record, and the physical file once the transaction commits
     - Decrements both original_storage_used and total_storage_used
     
     Args:
         user_id: The user ID requesting deletion
         file_id: The UUID of the file to delete
         
+    Returns:
+        The user ID owning the original whose reference_count was decremented
+        (when a reference was deleted), otherwise None
+        
     Raises:
         ValueError: If user_id is missing or invalid
         NotFound: If file doesn't exist or doesn't belong to user
@@ -55,62 +78,57 @@ def delete_file(user_id: str, file_id: str) -> None:
     """
     validate_user_id(user_id)
     
-    logger.info(f"Processing deletion for user_id={user_id}, file_id={file_id}")
+    logger.info("Processing deletion for user_id=%s, file_id=%s", user_id, file_id)
     
     try:
-        file_obj = File.objects.get(id=file_id, user_id=user_id)
+        # Only load the columns the deletion path reads
+        file_obj = File.objects.only(
+            'id', 'is_reference', 'size', 'file', 'user_id', 'original_file_id'
+        ).get(id=file_id, user_id=user_id)
     except ObjectDoesNotExist:
-        logger.warning(f"File not found: file_id={file_id}, user_id={user_id}")
+        logger.warning("File not found: file_id=%s, user_id=%s", file_id, user_id)
         raise NotFound()
 
-    stats, _ = UserStats.objects.get_or_create(user_id=user_id)
-
     if file_obj.is_reference:
         # Delete reference record only
-        logger.info(f"Deleting reference file_id={file_id}")
+        logger.info("Deleting reference file_id=%s", file_id)
         size = file_obj.size or 0
-        stats.original_storage_used = max(0, (stats.original_storage_used or 0) - size)
-        stats.save(update_fields=["original_storage_used", "updated_at"])
+        bump_user_stats(user_id, original_delta=-size)
+        File.objects.filter(pk=file_obj.original_file_id).update(
+            reference_count=F('reference_count') - 1
+        )
         file_obj.delete()
-        logger.info(f"Reference deleted successfully: file_id={file_id}")
-        return
+        logger.info("Reference deleted successfully: file_id=%s", file_id)
+        return File.objects.filter(pk=file_obj.original_file_id).values_list('user_id', flat=True).first()
 
     # It's an original - check if ANY user has references to it
     # We prevent deletion if ANY user (including the current user) has references
-    # Use exists() for better performance when we only need to check existence
-    has_references = File.objects.filter(original_file=file_obj).exists()
-    if has_references:
-        # Get count only for logging purposes
-        ref_count = File.objects.filter(original_file=file_obj).count()
+    # A single COUNT on the indexed FK serves both the check and the log message
+    ref_count = File.objects.filter(original_file_id=file_obj.pk).count()
+    if ref_count:
         logger.warning(
-            f"Cannot delete original file_id={file_id}: "
-            f"{ref_count} reference(s) exist"
+            "Cannot delete original file_id=%s: %d reference(s) exist",
+            file_id, ref_count,
         )
         raise ConflictError()
 
     # Delete storage and object
-    logger.info(f"Deleting original file_id={file_id}")
+    logger.info("Deleting original file_id=%s", file_id)
     storage_file = file_obj.file
     size = file_obj.size or 0
     
     # Delete database record first
     file_obj.delete()
     
-    # Attempt to delete physical file
+    # Remove the physical file only after commit, so no row locks are held
+    # during storage I/O and a rolled-back delete keeps its file
     if storage_file:
-        try:
-            storage_file.delete(save=False)
-            logger.debug(f"Physical file deleted for file_id={file_id}")
-        except Exception as e:
-            # Ignore physical delete failures to keep API responsive
-            # File record is already gone, so this is non-critical
-            logger.warning(f"Failed to delete physical file for file_id={file_id}: {e}")
+        transaction.on_commit(lambda: _delete_stored_file(storage_file, file_id))
 
     # Update user stats
-    stats.original_storage_used = max(0, (stats.original_storage_used or 0) - size)
-    stats.total_storage_used = max(0, (stats.total_storage_used or 0) - size)
-    stats.save(update_fields=["original_storage_used", "total_storage_used", "updated_at"])
+    bump_user_stats(user_id, original_delta=-size, total_delta=-size)
     
-    logger.info(f"Original file deleted successfully: file_id={file_id}, user_id={user_id}")
+    logger.info("Original file deleted successfully: file_id=%s, user_id=%s", file_id, user_id)
+    return None
 
 
@@ -2,13 +2,12 @@
 File search and filtering service.
 
 This module provides file search and filtering capabilities, including
-reference count annotation and FTS (Full-Text Search) support.
+FTS (Full-Text Search) support.
 """
 
 import logging
 from typing import List, Optional
-from django.db.models import QuerySet, OuterRef, Subquery, IntegerField, Value, Count
-from django.db.models.functions import Coalesce
+from django.db.models import QuerySet
 from django.conf import settings
 from django_filters import rest_framework as django_filters
 from files.models import File
@@ -17,26 +16,6 @@ from files.utils import validate_user_id
 logger = logging.getLogger(__name__)
 
 
-def _reference_count_subquery():
-    """
-    Create a subquery to count references for each original file.
-    
-    Returns:
-        Coalesce expression that returns 0 if no references exist,
-        otherwise returns the count of references.
-    """
-    return Coalesce(
-        Subquery(
-            File.objects.filter(original_file=OuterRef('pk'))
-            .values('original_file')
-            .annotate(c=Count('*'))
-            .values('c')[:1]
-        ),
-        Value(0),
-        output_field=IntegerField(),
-    )
-
-
 class FileFilter(django_filters.FilterSet):
     """
     FilterSet for file search and filtering.
@@ -92,8 +71,7 @@ def search_files_for_user(user_id: str, params: dict) -> QuerySet[File]:
         params: Query parameters for filtering (from request.query_params)
         
     Returns:
-        QuerySet of File objects filtered by user_id and params,
-        annotated with reference_count for each file.
+        QuerySet of File objects filtered by user_id and params.
         
     Note:
         Returns empty queryset if user_id is invalid.
@@ -102,15 +80,15 @@ def search_files_for_user(user_id: str, params: dict) -> QuerySet[File]:
         logger.warning("search_files_for_user called with empty user_id")
         return File.objects.none()
     
-    # Filter by user_id and annotate with reference_count
-    # Use select_related for foreign key (original_file) to avoid N+1 queries
-    qs = File.objects.filter(user_id=user_id).select_related('original_file')
-    qs = qs.annotate(reference_count=_reference_count_subquery())
+    # Filter by user_id; reference_count is a stored column, no annotation needed.
+    # No select_related: the serializer only emits original_file_id, already on the row.
+    qs = File.objects.filter(user_id=user_id)
     
     # Apply filters from query parameters
     file_filter = FileFilter(params, queryset=qs)
     
-    logger.debug(f"Search for user_id={user_id}, params={params}, count={file_filter.qs.count()}")
+    # No count() here: it would cost a query per request; the paginator counts downstream
+    logger.debug("Search for user_id=%s, params=%s", user_id, params)
     return file_filter.qs
 
 
@@ -135,7 +113,7 @@ def distinct_file_types_for_user(user_id: str) -> List[str]:
         .order_by('file_type')
     )
     
-    logger.debug(f"File types for user_id={user_id}: {len(file_types)} distinct types")
+    logger.debug("File types for user_id=%s: %d distinct types", user_id, len(file_types))
     return file_types
 
 
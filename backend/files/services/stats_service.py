@@ -6,13 +6,67 @@ including total storage, original storage, and savings from deduplication.
 """
 
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest, Now
 from files.models import UserStats
 from files.utils import validate_user_id
 
 logger = logging.getLogger(__name__)
 
 
+def bump_user_stats(
+    user_id: str,
+    original_delta: int = 0,
+    total_delta: int = 0,
+    total_limit: Optional[int] = None,
+) -> bool:
+    """
+    Apply storage deltas to a user's statistics in a single UPDATE.
+    
+    Both counters are clamped at zero in the database. The row is only
+    inserted when the user has no statistics yet, so the common case is one
+    query instead of get_or_create + save.
+    
+    Args:
+        user_id: The user ID whose statistics change
+        original_delta: Bytes to add to original_storage_used (may be negative)
+        total_delta: Bytes to add to total_storage_used (may be negative)
+        total_limit: If given, the update is only applied when the resulting
+            total_storage_used stays within this many bytes
+            
+    Returns:
+        bool: True if the deltas were applied, False if total_limit would be exceeded
+    """
+    qs = UserStats.objects.filter(user_id=user_id)
+    if total_limit is not None:
+        qs = qs.filter(total_storage_used__lte=total_limit - total_delta)
+    rows = qs.update(
+        original_storage_used=Greatest(F('original_storage_used') + original_delta, 0),
+        total_storage_used=Greatest(F('total_storage_used') + total_delta, 0),
+        updated_at=Now(),
+    )
+    if rows:
+        return True
+    
+    if total_limit is not None:
+        # Either the row exists and is over the limit, or there is no row yet
+        if total_delta > total_limit or UserStats.objects.filter(user_id=user_id).exists():
+            return False
+    try:
+        with transaction.atomic():
+            UserStats.objects.create(
+                user_id=user_id,
+                original_storage_used=max(0, original_delta),
+                total_storage_used=max(0, total_delta),
+            )
+    except IntegrityError:
+        # Created concurrently by another request; apply the deltas to that row
+        return bump_user_stats(user_id, original_delta, total_delta, total_limit)
+    return True
+
+
 def get_storage_stats(user_id: str) -> Dict[str, Any]:
     """
     Get storage statistics for a user.
@@ -55,7 +109,7 @@ def get_storage_stats(user_id: str) -> Dict[str, Any]:
         "savings_percentage": round(savings_percentage, 2),
     }
     
-    logger.debug(f"Storage stats for user_id={user_id}: {result}")
+    logger.debug("Storage stats for user_id=%s: %s", user_id, result)
     return result
 
 
@@ -1,18 +1,38 @@
 """
 File upload service with deduplication and quota management.
 
-This module handles file uploads, including SHA-256 hashing for deduplication,
+This module handles file uploads, including content hashing (SHA-256 by
+default, optionally BLAKE3) for deduplication,
 storage quota enforcement, and user statistics tracking.
 """
 
+import concurrent.futures
 import hashlib
 import logging
-from typing import Optional
+import os
+import sys
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Optional, Tuple
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.db import transaction
+from django.db.models import F
+from django.core.files import File as DjangoFile
 from django.core.files.uploadedfile import UploadedFile
 from rest_framework.exceptions import APIException
 from files.models import File, UserStats
-from files.constants import ERROR_STORAGE_QUOTA_EXCEEDED
+from files.services.stats_service import bump_user_stats
+from files.constants import (
+    DEDUP_CACHE_MAX_ENTRIES,
+    DEFAULT_HASH_ALGORITHM,
+    ERROR_STORAGE_QUOTA_EXCEEDED,
+    HASH_ALGORITHM_BLAKE3,
+    HASH_POOL_WORKERS,
+    HASH_READ_BLOCK_SIZE,
+)
 from files.utils import (
     get_storage_quota_bytes,
     validate_user_id,
@@ -21,8 +41,31 @@ from files.utils import (
     get_original_filename,
 )
 
+try:
+    import blake3
+except ImportError:  # optional; only needed for FILE_VAULT_HASH_ALGORITHM='blake3'
+    blake3 = None
+
 logger = logging.getLogger(__name__)
 
+# Process-local LRU of file_hash -> primary key of the original with that hash.
+# Entries are only hints: every hit is confirmed with a primary-key lookup.
+_ORIGINAL_CACHE: "OrderedDict[str, uuid.UUID]" = OrderedDict()
+_ORIGINAL_CACHE_LOCK = threading.Lock()
+
+# Only Linux's sendfile(2) accepts a regular file as the destination; macOS and
+# the BSDs require a socket and fail with ENOTSOCK
+_SENDFILE_TO_FILE = hasattr(os, 'sendfile') and sys.platform.startswith('linux')
+
+# File.file, whose storage and max_length every stored original goes through
+_FILE_FIELD = File._meta.get_field('file')
+
+# Hashes disk-backed uploads while the request thread copies them into storage;
+# both hashlib and os.sendfile release the GIL, so the two run in parallel.
+_HASH_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=HASH_POOL_WORKERS, thread_name_prefix='upload-hash'
+)
+
 
 class QuotaExceeded(APIException):
     """Exception raised when storage quota is exceeded."""
@@ -33,57 +76,225 @@ class QuotaExceeded(APIException):
         super().__init__(self.default_detail)
 
 
-def _compute_sha256_streaming(uploaded_file: UploadedFile) -> str:
+def _new_hasher():
+    """
+    Create a hash object for the configured FILE_VAULT_HASH_ALGORITHM.
+    
+    SHA-256 is the default. BLAKE3 (requires the optional ``blake3`` package)
+    splits large inputs across all cores and is several times faster; both
+    produce 64-character hex digests.
+    
+    Raises:
+        ImproperlyConfigured: If BLAKE3 is selected but not installed
+    """
+    algorithm = getattr(settings, 'FILE_VAULT_HASH_ALGORITHM', DEFAULT_HASH_ALGORITHM)
+    if algorithm == HASH_ALGORITHM_BLAKE3:
+        if blake3 is None:
+            raise ImproperlyConfigured(
+                "FILE_VAULT_HASH_ALGORITHM='blake3' requires the blake3 package"
+            )
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+    return hashlib.sha256()
+
+
+def _compute_hash_streaming(uploaded_file: UploadedFile) -> str:
     """
-    Compute SHA-256 hash of uploaded file using streaming to avoid loading entire file into memory.
+    Compute the content hash of uploaded file using streaming to avoid loading entire file into memory.
+    
+    Uses hashlib.file_digest (Python 3.11+), which hashes the file object in a
+    single C loop. Older interpreters fall back to reading large blocks so the
+    per-block Python overhead stays small.
     
     Args:
         uploaded_file: The uploaded file to hash
         
     Returns:
-        str: SHA-256 hex digest (64 characters)
+        str: Hex digest (64 characters)
         
     Note:
         The file pointer is reset to the beginning after hashing to allow
         subsequent reads of the file content.
     """
-    sha256 = hashlib.sha256()
     # Reset file pointer to beginning
     if hasattr(uploaded_file, 'seek'):
         uploaded_file.seek(0)
     
-    # Stream file in chunks to avoid memory issues with large files
-    for chunk in uploaded_file.chunks():
-        sha256.update(chunk)
+    if hasattr(hashlib, 'file_digest'):
+        digest = hashlib.file_digest(uploaded_file, _new_hasher).hexdigest()
+    else:
+        hasher = _new_hasher()
+        # Stream file in large blocks to avoid memory issues with large files
+        for block in iter(lambda: uploaded_file.read(HASH_READ_BLOCK_SIZE), b''):
+            hasher.update(block)
+        digest = hasher.hexdigest()
     
     # Reset file pointer again after hashing for subsequent reads
     if hasattr(uploaded_file, 'seek'):
         uploaded_file.seek(0)
     
-    return sha256.hexdigest()
+    return digest
 
 
-def _get_or_create_user_stats(user_id: str) -> UserStats:
+def _sendfile_copy(uploaded_file: UploadedFile, out) -> None:
     """
-    Get or create UserStats record for a user.
+    Copy a disk-backed upload into ``out`` using os.sendfile (kernel-side copy).
     
     Args:
-        user_id: The user ID
+        uploaded_file: A TemporaryUploadedFile backed by a real file descriptor
+        out: Open binary file object to copy into
+    """
+    in_fd = uploaded_file.file.fileno()
+    out_fd = out.fileno()
+    remaining = os.fstat(in_fd).st_size
+    offset = 0
+    while remaining > 0:
+        sent = os.sendfile(out_fd, in_fd, offset, remaining)
+        if sent == 0:
+            break
+        offset += sent
+        remaining -= sent
+
+
+class _HashedUpload(DjangoFile):
+    """
+    The temporary copy written by _write_and_hash, opened for storage.save().
+    
+    temporary_file_path() lets FileSystemStorage move it into place and apply
+    FILE_UPLOAD_PERMISSIONS instead of copying it; other storage backends read
+    it like any other file.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(open(path, 'rb'), name=os.path.basename(path))
+        self._path = path
+
+    def temporary_file_path(self) -> str:
+        return self._path
+
+
+def _temp_dir_for(storage, name: str) -> str:
+    """
+    Directory for the temporary copy of an upload that will be saved as ``name``.
+    
+    Local storage gets the destination directory itself so the final move is
+    a rename; backends without local paths use Django's upload temp dir.
+    """
+    try:
+        return os.path.dirname(storage.path(name))
+    except NotImplementedError:
+        return settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir()
+
+
+def _sendfile_and_hash(uploaded_file: UploadedFile, out) -> Optional[str]:
+    """
+    Copy a disk-backed upload into ``out`` with os.sendfile while a worker hashes it.
+    
+    Returns:
+        str or None: Hex digest, or None if sendfile failed and the caller
+        should fall back to the chunked copy (the hashing thread is done with
+        the file by then)
+    """
+    # sendfile reads at explicit offsets, so it doesn't disturb the file
+    # position the hashing thread reads from
+    hash_future = _HASH_POOL.submit(_compute_hash_streaming, uploaded_file)
+    try:
+        _sendfile_copy(uploaded_file, out)
+    except OSError as e:
+        logger.debug("sendfile failed (%s), falling back to chunked copy", e)
+        hash_future.cancel()
+        return None
+    finally:
+        # Always wait so the hashing thread is done with the file
+        concurrent.futures.wait([hash_future])
+    return hash_future.result()
+
+
+def _write_and_hash(uploaded_file: UploadedFile, temp_dir: str) -> Tuple[str, str]:
+    """
+    Stream the upload to a temporary file in ``temp_dir`` while hashing it.
+    
+    In-memory uploads are hashed and written chunk by chunk in a single pass.
+    On Linux, uploads already spooled to disk by Django are hashed on a worker
+    thread while being copied with os.sendfile, so the copy never passes the
+    bytes through Python and overlaps with the hash instead of following it.
+    If sendfile fails, the copy restarts with the chunked loop.
+    
+    Args:
+        uploaded_file: The uploaded file to store
+        temp_dir: Directory for the temporary file (ideally the same
+            filesystem as the final location so it can be renamed into place)
         
     Returns:
-        UserStats: The user statistics record
+        tuple: (hex digest, path of the temporary file)
     """
-    stats, _ = UserStats.objects.get_or_create(user_id=user_id)
-    return stats
+    os.makedirs(temp_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=temp_dir, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            file_hash = None
+            if _SENDFILE_TO_FILE and hasattr(uploaded_file, 'temporary_file_path'):
+                file_hash = _sendfile_and_hash(uploaded_file, out)
+                if file_hash is None:
+                    # Discard whatever sendfile copied; chunks() rewinds the upload
+                    out.seek(0)
+                    out.truncate()
+            if file_hash is None:
+                hasher = _new_hasher()
+                for chunk in uploaded_file.chunks(HASH_READ_BLOCK_SIZE):
+                    hasher.update(chunk)
+                    out.write(chunk)
+                file_hash = hasher.hexdigest()
+    except Exception:
+        os.unlink(temp_path)
+        raise
+    return file_hash, temp_path
+
+
+def _remember_original(file_hash: str, file_id: uuid.UUID) -> None:
+    """Record the original for ``file_hash`` in the LRU, evicting the oldest entry."""
+    with _ORIGINAL_CACHE_LOCK:
+        _ORIGINAL_CACHE[file_hash] = file_id
+        _ORIGINAL_CACHE.move_to_end(file_hash)
+        if len(_ORIGINAL_CACHE) > DEDUP_CACHE_MAX_ENTRIES:
+            _ORIGINAL_CACHE.popitem(last=False)
+
+
+def _find_existing_original(file_hash: str) -> Optional[File]:
+    """
+    Find the original File with the given hash, across all users.
+    
+    A cached hash is confirmed with a primary-key lookup instead of probing the
+    hash index; stale entries (original deleted) fall back to the hash query.
+    
+    Args:
+        file_hash: SHA-256 hex digest of the uploaded content
+        
+    Returns:
+        File or None: The original (only ``id`` and ``user_id`` loaded on a cache hit)
+    """
+    with _ORIGINAL_CACHE_LOCK:
+        cached_id = _ORIGINAL_CACHE.get(file_hash)
+        if cached_id is not None:
+            _ORIGINAL_CACHE.move_to_end(file_hash)
+    if cached_id is not None:
+        original = File.objects.filter(pk=cached_id).only('id', 'user_id').first()
+        if original is not None:
+            return original
+        with _ORIGINAL_CACHE_LOCK:
+            _ORIGINAL_CACHE.pop(file_hash, None)
+    
+    original = File.objects.filter(file_hash=file_hash, is_reference=False).first()
+    if original is not None:
+        _remember_original(file_hash, original.pk)
+    return original
 
 
-@transaction.atomic
 def handle_upload(user_id: str, uploaded_file: UploadedFile) -> File:
     """
     Handle file upload with deduplication and quota enforcement.
     
     This function:
-    1. Computes SHA-256 hash of the uploaded file
+    1. Streams the file to a temporary copy while computing its content hash
     2. Checks for existing file with the same hash
     3. Creates a reference record if duplicate exists, otherwise creates new original
     4. Enforces storage quota for new originals
@@ -101,35 +312,77 @@ def handle_upload(user_id: str, uploaded_file: UploadedFile) -> File:
         QuotaExceeded: If uploading a new original would exceed storage quota
         
     Note:
-        This function is atomic - either all changes succeed or none do.
+        This function is atomic - either all changes succeed or none do. A
+        stored original is deleted again if its transaction doesn't commit.
     """
     validate_user_id(user_id)
     
-    logger.info(f"Processing upload for user_id={user_id}, filename={getattr(uploaded_file, 'name', 'unknown')}")
+    logger.info(
+        "Processing upload for user_id=%s, filename=%s",
+        user_id, getattr(uploaded_file, 'name', 'unknown'),
+    )
     
-    # Compute hash and extract metadata
-    file_hash = _compute_sha256_streaming(uploaded_file)
     size = get_file_size(uploaded_file)
     file_type = get_file_type(uploaded_file)
     original_filename = get_original_filename(uploaded_file)
 
-    logger.debug(f"File hash={file_hash[:8]}..., size={size}, type={file_type}")
+    # Hash while writing a temporary copy; the name goes through the field's
+    # upload_to and the storage's get_valid_name, like FileField.save would
+    storage = _FILE_FIELD.storage
+    storage_name = _FILE_FIELD.generate_filename(None, original_filename)
+    file_hash, temp_path = _write_and_hash(uploaded_file, _temp_dir_for(storage, storage_name))
+    saved_names = []
+    try:
+        with transaction.atomic():
+            return _record_upload(
+                user_id, file_hash, size, file_type, original_filename,
+                temp_path, storage_name, saved_names,
+            )
+    except BaseException:
+        # Nothing was committed, so don't leave the stored content orphaned
+        for name in saved_names:
+            storage.delete(name)
+        raise
+    finally:
+        # Temp file is only left behind when the upload was deduplicated or rejected
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
 
-    # Lookup existing original across all users (for deduplication)
-    # The new file record will always be scoped to user_id
-    existing_original = File.objects.filter(
-        file_hash=file_hash, 
-        is_reference=False
-    ).first()
 
-    stats = _get_or_create_user_stats(user_id)
+def _record_upload(
+    user_id: str,
+    file_hash: str,
+    size: int,
+    file_type: str,
+    original_filename: str,
+    temp_path: str,
+    storage_name: str,
+    saved_names: list,
+) -> File:
+    """
+    Create the File record for an already hashed upload and update user statistics.
+    
+    Saves the temporary file to storage under ``storage_name`` only when a new
+    original is created, appending the stored name to ``saved_names`` so the
+    caller can delete it if the transaction rolls back. Duplicates and quota
+    rejections leave the temporary file for the caller to remove.
+    
+    Returns:
+        File: The created File record (either original or reference)
+        
+    Raises:
+        QuotaExceeded: If uploading a new original would exceed storage quota
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("File hash=%s..., size=%s, type=%s", file_hash[:8], size, file_type)
 
-    # Always increase original_storage_used by uploaded size
-    stats.original_storage_used = (stats.original_storage_used or 0) + size
+    # Lookup existing original across all users (for deduplication)
+    # The new file record will always be scoped to user_id
+    existing_original = _find_existing_original(file_hash)
 
     if existing_original:
         # Create a reference record for this user
-        logger.info(f"Duplicate detected, creating reference to original file_id={existing_original.id}")
+        logger.info("Duplicate detected, creating reference to original file_id=%s", existing_original.id)
         new_file = File.objects.create(
             file=None,
             original_filename=original_filename,
@@ -140,27 +393,34 @@ def handle_upload(user_id: str, uploaded_file: UploadedFile) -> File:
             is_reference=True,
             original_file=existing_original,
         )
-        # total_storage_used unchanged for references
-        stats.save(update_fields=["original_storage_used", "updated_at"])
+        File.objects.filter(pk=existing_original.pk).update(
+            reference_count=F('reference_count') + 1
+        )
+        # Always increase original_storage_used; total_storage_used unchanged for references
+        bump_user_stats(user_id, original_delta=size)
         return new_file
 
-    # Enforce quota for new originals
+    # Enforce quota for new originals: the stats update only applies within quota
     quota_bytes = get_storage_quota_bytes()
-    current_usage = stats.total_storage_used or 0
-    
-    if current_usage + size > quota_bytes:
+    if not bump_user_stats(user_id, original_delta=size, total_delta=size, total_limit=quota_bytes):
+        current_usage = UserStats.objects.filter(user_id=user_id).values_list(
+            'total_storage_used', flat=True
+        ).first() or 0
         logger.warning(
-            f"Quota exceeded for user_id={user_id}: "
-            f"current={current_usage}, requested={size}, quota={quota_bytes}"
+            "Quota exceeded for user_id=%s: current=%s, requested=%s, quota=%s",
+            user_id, current_usage, size, quota_bytes,
         )
-        # Revert original_storage_used increment within this atomic transaction
         transaction.set_rollback(True)
         raise QuotaExceeded()
 
     # Save new original file
-    logger.info(f"Creating new original file for user_id={user_id}")
+    logger.info("Creating new original file for user_id=%s", user_id)
+    with _HashedUpload(temp_path) as content:
+        # max_length makes over-long names fail here, before the row is written
+        stored_name = _FILE_FIELD.storage.save(storage_name, content, max_length=_FILE_FIELD.max_length)
+    saved_names.append(stored_name)
     new_file = File.objects.create(
-        file=uploaded_file,
+        file=stored_name,
         original_filename=original_filename,
         file_type=file_type,
         size=size,
@@ -169,11 +429,9 @@ def handle_upload(user_id: str, uploaded_file: UploadedFile) -> File:
         is_reference=False,
         original_file=None,
     )
+    _remember_original(file_hash, new_file.pk)
 
-    stats.total_storage_used = current_usage + size
-    stats.save(update_fields=["original_storage_used", "total_storage_used", "updated_at"])
-    
-    logger.info(f"Upload successful: file_id={new_file.id}, user_id={user_id}")
+    logger.info("Upload successful: file_id=%s, user_id=%s", new_file.id, user_id)
     return new_file
 
 
@@ -1,32 +1,137 @@
 """
 Comprehensive test suite for Abnormal File Vault application.
 Run with: python manage.py test files.tests
+
+Every test works under its own random user id and asserts only on that
+user's rows, so the suite is safe with ``--keepdb`` (reuse the migrated
+test database between runs) and ``--parallel``.
 """
-from django.test import TestCase, Client
-from django.core.files.uploadedfile import SimpleUploadedFile
-from rest_framework.test import APIClient
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import SuspiciousFileOperation
+from django.db import DatabaseError
+from django.http import HttpResponse
+from django.test import TestCase, Client, RequestFactory, override_settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import InMemoryUploadedFile, SimpleUploadedFile, TemporaryUploadedFile
+from rest_framework.test import APIClient, APIRequestFactory
 from rest_framework import status
-from unittest.mock import patch, MagicMock
+from unittest import skipUnless
+from unittest.mock import patch
+import errno
+import functools
 import hashlib
+import importlib.util
 import io
+import json
+import logging
+import logging.handlers
+import os
+import shutil
+import tempfile
+from uuid import uuid4
 from files.models import File, UserStats
+from files.serializers import FileSerializer, LIST_VALUE_FIELDS
+from files import views
+from files.views import FileViewSet
 from files.services.upload_service import handle_upload, QuotaExceeded
 from files.services.delete_service import delete_file, ConflictError
 from files.services.search_service import search_files_for_user, distinct_file_types_for_user
-from files.services.stats_service import get_storage_stats
+from files.services.stats_service import get_storage_stats, bump_user_stats
+from files.throttling import UserIdRateThrottle
+from files.utils import current_user_id
+from core import logging_config
+from core.user_id_middleware import UserIdMiddleware
 from rest_framework.exceptions import NotFound
 
 
-class FileModelTestCase(TestCase):
+MB = 1024 * 1024
+
+# Cheap hasher in case a test ever creates auth users; PBKDF2 is deliberately slow
+TEST_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+
+def _user_id():
+    """Return a user id unique to the calling test, so no two tests share rows"""
+    return f"u-{uuid4().hex[:8]}"
+
+
+@functools.lru_cache(maxsize=None)
+def _payload(size, fill=b"x"):
+    """Return a ``size``-byte buffer, built once per run and shared by the quota tests"""
+    return fill * size
+
+
+class _FakeHasher:
+    """Stand-in for the upload hasher that skips hashing and returns a unique digest"""
+    
+    def update(self, data):
+        pass
+    
+    def hexdigest(self):
+        return uuid4().hex * 2
+
+
+def _skip_hashing(test):
+    """
+    Decorate a test whose uploads all have distinct content and never check digests.
+    
+    Every upload gets a fresh fake hash, so it never deduplicates.
+    """
+    return patch('files.services.upload_service._new_hasher', _FakeHasher)(test)
+
+
+def _uf(name="test.txt", content=b"test file content"):
+    """Build a fresh text/plain upload; each one is single-use since reading it advances it"""
+    return SimpleUploadedFile(name, content, content_type="text/plain")
+
+
+def _mem_file(buf, name):
+    """Wrap a shared payload from _payload() as an in-memory upload named ``name``"""
+    return InMemoryUploadedFile(io.BytesIO(buf), 'file', name, 'text/plain', len(buf), None)
+
+
+def _make_file(user, content=b"test file content", is_reference=False, original=None,
+               name="test.txt", reference_count=0):
+    """
+    Build an unsaved File row for bulk_create without going through handle_upload.
+
+    Only originals get stored content; references point at ``original`` the
+    same way handle_upload would link them.
+    """
+    return File(
+        file=None if is_reference else ContentFile(content, name="x.txt"),
+        original_filename=name,
+        file_type="text/plain",
+        size=len(content),
+        user_id=user,
+        file_hash=hashlib.sha256(content).hexdigest(),
+        is_reference=is_reference,
+        original_file=original,
+        reference_count=reference_count,
+    )
+
+
+class TempMediaTestCase(TestCase):
+    """TestCase whose uploads go to a throwaway MEDIA_ROOT, removed after the class"""
+    
+    @classmethod
+    def setUpClass(cls):
+        media_root = tempfile.mkdtemp(prefix='fv_tests_')
+        cls.addClassCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media_override = override_settings(MEDIA_ROOT=media_root)
+        media_override.enable()
+        cls.addClassCleanup(media_override.disable)
+        super().setUpClass()
+
+
+@override_settings(PASSWORD_HASHERS=TEST_HASHERS)
+class FileModelTestCase(TempMediaTestCase):
     """Test File model functionality"""
     
     def setUp(self):
         self.test_content = b"test file content"
-        self.test_file = SimpleUploadedFile(
-            "test.txt",
-            self.test_content,
-            content_type="text/plain"
-        )
+        self.test_file = _uf("test.txt", self.test_content)
     
     def test_file_creation(self):
         """Test creating a file record"""
@@ -35,7 +140,7 @@ class FileModelTestCase(TestCase):
             original_filename="test.txt",
             file_type="text/plain",
             size=len(self.test_content),
-            user_id="user1",
+            user_id=_user_id(),
             file_hash="abc123",
             is_reference=False,
         )
@@ -51,21 +156,17 @@ class FileModelTestCase(TestCase):
             original_filename="original.txt",
             file_type="text/plain",
             size=len(self.test_content),
-            user_id="user1",
+            user_id=_user_id(),
             file_hash="abc123",
             is_reference=False,
         )
         # Create a new file for reference (no file field)
-        reference_file = SimpleUploadedFile(
-            "reference.txt",
-            self.test_content,
-            content_type="text/plain"
-        )
+        reference_file = _uf("reference.txt", self.test_content)
         reference = File.objects.create(
             original_filename="reference.txt",
             file_type="text/plain",
             size=len(self.test_content),
-            user_id="user2",
+            user_id=_user_id(),
             file_hash="abc123",
             is_reference=True,
             original_file=original,
@@ -76,33 +177,33 @@ class FileModelTestCase(TestCase):
         self.assertFalse(reference.file)  # FieldFile evaluates to False when empty
 
 
+@override_settings(PASSWORD_HASHERS=TEST_HASHERS)
 class UserStatsModelTestCase(TestCase):
     """Test UserStats model functionality"""
     
     def test_user_stats_creation(self):
         """Test creating user stats"""
+        user_id = _user_id()
         stats = UserStats.objects.create(
-            user_id="user1",
+            user_id=user_id,
             total_storage_used=1024,
             original_storage_used=2048,
         )
-        self.assertEqual(stats.user_id, "user1")
+        self.assertEqual(stats.user_id, user_id)
         self.assertEqual(stats.total_storage_used, 1024)
         self.assertEqual(stats.original_storage_used, 2048)
 
 
-class UploadServiceTestCase(TestCase):
+@override_settings(PASSWORD_HASHERS=TEST_HASHERS)
+class UploadServiceTestCase(TempMediaTestCase):
     """Test upload service functionality"""
     
     def setUp(self):
         self.test_content = b"test file content"
-        self.test_file = SimpleUploadedFile(
-            "test.txt",
-            self.test_content,
-            content_type="text/plain"
-        )
-        self.user_id = "user1"
+        self.test_file = _uf("test.txt", self.test_content)
+        self.user_id = _user_id()
     
+    @_skip_hashing
     def test_upload_new_file(self):
         """Test uploading a new file"""
         file_obj = handle_upload(self.user_id, self.test_file)
@@ -121,11 +222,7 @@ class UploadServiceTestCase(TestCase):
         original = handle_upload(self.user_id, self.test_file)
         
         # Create another file with same content
-        test_file2 = SimpleUploadedFile(
-            "test2.txt",
-            self.test_content,
-            content_type="text/plain"
-        )
+        test_file2 = _uf("test2.txt", self.test_content)
         
         # Upload duplicate
         reference = handle_upload(self.user_id, test_file2)
@@ -139,86 +236,89 @@ class UploadServiceTestCase(TestCase):
         self.assertEqual(stats.total_storage_used, len(self.test_content))  # Only original counts
         self.assertEqual(stats.original_storage_used, len(self.test_content) * 2)  # Both files count
     
+    def test_upload_after_original_deleted_is_new_original(self):
+        """Test that a cached hash whose original was deleted doesn't produce a reference"""
+        original = handle_upload(self.user_id, self.test_file)
+        delete_file(self.user_id, str(original.id))
+        
+        again = _uf("again.txt", self.test_content)
+        file_obj = handle_upload(self.user_id, again)
+        self.assertFalse(file_obj.is_reference)
+        self.assertNotEqual(file_obj.id, original.id)
+    
+    @skipUnless(importlib.util.find_spec('blake3'), "blake3 not installed")
+    def test_upload_with_blake3(self):
+        """Test deduplication when FILE_VAULT_HASH_ALGORITHM is blake3"""
+        import blake3
+        with override_settings(FILE_VAULT_HASH_ALGORITHM='blake3'):
+            original = handle_upload(self.user_id, self.test_file)
+            duplicate = _uf("dup.txt", self.test_content)
+            reference = handle_upload(self.user_id, duplicate)
+        self.assertEqual(original.file_hash, blake3.blake3(self.test_content).hexdigest())
+        self.assertTrue(reference.is_reference)
+    
+    @_skip_hashing
     def test_upload_quota_exceeded(self):
         """Test that quota is enforced"""
-        # Set quota to 1 byte (very small)
-        with patch('django.conf.settings.FILE_VAULT_STORAGE_QUOTA_MB', 0.000001):
-            large_content = b"x" * (2 * 1024 * 1024)  # 2MB
-            large_file = SimpleUploadedFile(
-                "large.txt",
-                large_content,
-                content_type="text/plain"
-            )
+        # Set quota to 0 bytes
+        with override_settings(FILE_VAULT_STORAGE_QUOTA_MB=0):
+            large_content = _payload(2 * MB)
+            large_file = _mem_file(large_content, "large.txt")
             with self.assertRaises(QuotaExceeded):
                 handle_upload(self.user_id, large_file)
     
+    @_skip_hashing
     def test_upload_file_over_10mb_quota(self):
         """Test uploading a file larger than default 10MB quota"""
         # Default quota is 10MB = 10 * 1024 * 1024 bytes
         quota_bytes = 10 * 1024 * 1024
         # Create file that exceeds quota by 1MB
-        large_content = b"x" * (quota_bytes + 1024 * 1024)  # 11MB
-        large_file = SimpleUploadedFile(
-            "large_11mb.txt",
-            large_content,
-            content_type="text/plain"
-        )
+        large_content = _payload(quota_bytes + MB)  # 11MB
+        large_file = _mem_file(large_content, "large_11mb.txt")
         with self.assertRaises(QuotaExceeded):
             handle_upload(self.user_id, large_file)
         
         # Verify no file was created
         self.assertEqual(File.objects.filter(user_id=self.user_id).count(), 0)
     
+    @_skip_hashing
     def test_upload_file_exactly_at_quota_limit(self):
         """Test uploading a file exactly at the quota limit"""
         quota_bytes = 10 * 1024 * 1024  # 10MB
         # Create file exactly at quota
-        exact_content = b"x" * quota_bytes
-        exact_file = SimpleUploadedFile(
-            "exact_10mb.txt",
-            exact_content,
-            content_type="text/plain"
-        )
+        exact_content = _payload(quota_bytes)
+        exact_file = _mem_file(exact_content, "exact_10mb.txt")
         # Should succeed at exact limit
         file_obj = handle_upload(self.user_id, exact_file)
         self.assertIsNotNone(file_obj.id)
         stats = UserStats.objects.get(user_id=self.user_id)
         self.assertEqual(stats.total_storage_used, quota_bytes)
     
+    @_skip_hashing
     def test_upload_multiple_files_cumulative_quota(self):
         """Test that cumulative file uploads respect quota"""
         quota_bytes = 10 * 1024 * 1024  # 10MB
-        # Upload first file (5MB)
-        file1_size = 5 * 1024 * 1024
-        file1_content = b"x" * file1_size
-        file1 = SimpleUploadedFile("file1.txt", file1_content, content_type="text/plain")
-        handle_upload(self.user_id, file1)
-        
-        # Upload second file (4MB) - should succeed (total 9MB)
-        file2_size = 4 * 1024 * 1024
-        file2_content = b"y" * file2_size
-        file2 = SimpleUploadedFile("file2.txt", file2_content, content_type="text/plain")
-        handle_upload(self.user_id, file2)
+        # Earlier uploads are only visible to the quota check through UserStats
+        UserStats.objects.create(
+            user_id=self.user_id,
+            total_storage_used=quota_bytes - 1,
+            original_storage_used=quota_bytes - 1,
+        )
         
-        # Upload third file (2MB) - should fail (would be 11MB total)
-        file3_size = 2 * 1024 * 1024
-        file3_content = b"z" * file3_size
-        file3 = SimpleUploadedFile("file3.txt", file3_content, content_type="text/plain")
+        # Two bytes would go one over quota
         with self.assertRaises(QuotaExceeded):
-            handle_upload(self.user_id, file3)
+            handle_upload(self.user_id, _uf("over.txt", b"ab"))
+        self.assertFalse(File.objects.filter(user_id=self.user_id).exists())
         
-        # Verify only 2 files exist
-        self.assertEqual(File.objects.filter(user_id=self.user_id, is_reference=False).count(), 2)
+        # One byte fills it exactly
+        handle_upload(self.user_id, _uf("last.txt", b"a"))
         stats = UserStats.objects.get(user_id=self.user_id)
-        self.assertEqual(stats.total_storage_used, file1_size + file2_size)
+        self.assertEqual(stats.total_storage_used, quota_bytes)
     
+    @_skip_hashing
     def test_upload_empty_file(self):
         """Test uploading an empty file"""
-        empty_file = SimpleUploadedFile(
-            "empty.txt",
-            b"",
-            content_type="text/plain"
-        )
+        empty_file = _uf("empty.txt", b"")
         file_obj = handle_upload(self.user_id, empty_file)
         self.assertIsNotNone(file_obj.id)
         self.assertEqual(file_obj.size, 0)
@@ -226,13 +326,10 @@ class UploadServiceTestCase(TestCase):
         self.assertEqual(stats.total_storage_used, 0)
         self.assertEqual(stats.original_storage_used, 0)
     
+    @_skip_hashing
     def test_upload_very_small_file(self):
         """Test uploading a very small file (1 byte)"""
-        small_file = SimpleUploadedFile(
-            "small.txt",
-            b"x",
-            content_type="text/plain"
-        )
+        small_file = _uf("small.txt", b"x")
         file_obj = handle_upload(self.user_id, small_file)
         self.assertIsNotNone(file_obj.id)
         self.assertEqual(file_obj.size, 1)
@@ -242,83 +339,166 @@ class UploadServiceTestCase(TestCase):
     def test_quota_allows_reference_after_limit(self):
         """Test that quota doesn't prevent creating references when original exists"""
         quota_bytes = 10 * 1024 * 1024  # 10MB
+        small = b"sixteen byte pay"
         
-        # Upload original file (10MB) - exactly at quota
-        exact_content = b"x" * quota_bytes
-        original_file = SimpleUploadedFile(
-            "original.txt",
-            exact_content,
-            content_type="text/plain"
+        # Start just under quota so the small original fills it exactly
+        UserStats.objects.create(
+            user_id=self.user_id,
+            total_storage_used=quota_bytes - len(small),
+            original_storage_used=quota_bytes - len(small),
         )
-        original = handle_upload(self.user_id, original_file)
+        handle_upload(self.user_id, _uf("original.txt", small))
         
         # Upload same file again (should create reference, not count against quota)
-        duplicate_file = SimpleUploadedFile(
-            "duplicate.txt",
-            exact_content,
-            content_type="text/plain"
-        )
-        reference = handle_upload(self.user_id, duplicate_file)
+        reference = handle_upload(self.user_id, _uf("duplicate.txt", small))
         
         self.assertTrue(reference.is_reference)
-        # Total storage should still be 10MB (only original counts)
+        # Total storage stays at quota (only the original counts)
         stats = UserStats.objects.get(user_id=self.user_id)
         self.assertEqual(stats.total_storage_used, quota_bytes)
-        # But original_storage_used should include both
-        self.assertEqual(stats.original_storage_used, quota_bytes * 2)
+        # But original_storage_used includes the reference too
+        self.assertEqual(stats.original_storage_used, quota_bytes + len(small))
     
     def test_upload_missing_user_id(self):
         """Test that missing user_id raises error"""
         with self.assertRaises(ValueError):
             handle_upload("", self.test_file)
 
+    def test_upload_stores_content_without_temp_files(self):
+        """Test that originals are stored intact and duplicates leave no temp file behind"""
+        original = handle_upload(self.user_id, self.test_file)
+        duplicate = _uf("dup.txt", self.test_content)
+        handle_upload(self.user_id, duplicate)
+        
+        with original.file.open('rb') as f:
+            self.assertEqual(f.read(), self.test_content)
+        self.assertEqual(original.file_hash, hashlib.sha256(self.test_content).hexdigest())
+        upload_dir = os.path.dirname(original.file.path)
+        self.assertFalse([n for n in os.listdir(upload_dir) if n.endswith('.part')])
+    
+    def test_upload_temporary_file(self):
+        """Test uploading a disk-backed (TemporaryUploadedFile) upload"""
+        temp_upload = TemporaryUploadedFile("big.bin", "application/octet-stream", 0, None)
+        temp_upload.write(self.test_content)
+        temp_upload.flush()
+        temp_upload.size = len(self.test_content)
+        file_obj = handle_upload(self.user_id, temp_upload)
+        temp_upload.close()
+        
+        self.assertEqual(file_obj.file_hash, hashlib.sha256(self.test_content).hexdigest())
+        with file_obj.file.open('rb') as f:
+            self.assertEqual(f.read(), self.test_content)
+    
+    def test_upload_temporary_file_sendfile_fallback(self):
+        """Test that a failing os.sendfile falls back to the chunked copy"""
+        content = self.test_content * 1000
+        temp_upload = TemporaryUploadedFile("big.bin", "application/octet-stream", 0, None)
+        temp_upload.write(content)
+        temp_upload.flush()
+        temp_upload.size = len(content)
+        with patch('files.services.upload_service._SENDFILE_TO_FILE', True), \
+                patch('os.sendfile', side_effect=OSError(errno.ENOTSOCK, "Socket operation on non-socket")):
+            file_obj = handle_upload(self.user_id, temp_upload)
+        temp_upload.close()
+        
+        self.assertEqual(file_obj.file_hash, hashlib.sha256(content).hexdigest())
+        with file_obj.file.open('rb') as f:
+            self.assertEqual(f.read(), content)
+    
+    def test_upload_goes_through_storage(self):
+        """Test that stored originals get FILE_UPLOAD_PERMISSIONS and a storage-valid name"""
+        with override_settings(FILE_UPLOAD_PERMISSIONS=0o644):
+            original = handle_upload(self.user_id, _uf("odd.p h$p", self.test_content))
+        
+        self.assertTrue(original.file.name.endswith('.p_hp'))
+        self.assertEqual(os.stat(original.file.path).st_mode & 0o777, 0o644)
+    
+    def test_upload_name_too_long_rejected(self):
+        """Test that a name longer than File.file's max_length is rejected before anything is stored"""
+        before = self._stored_files()
+        with self.assertRaises(SuspiciousFileOperation):
+            handle_upload(self.user_id, _uf("long." + "x" * 120, self.test_content))
+        self.assertFalse(File.objects.filter(user_id=self.user_id).exists())
+        self.assertEqual(self._stored_files(), before)
+    
+    def test_upload_rollback_removes_stored_file(self):
+        """Test that a failed insert deletes the content already saved to storage"""
+        before = self._stored_files()
+        with patch.object(File.objects, 'create', side_effect=DatabaseError("insert failed")):
+            with self.assertRaises(DatabaseError):
+                handle_upload(self.user_id, self.test_file)
+        self.assertEqual(self._stored_files(), before)
+        self.assertFalse(UserStats.objects.filter(user_id=self.user_id, total_storage_used__gt=0).exists())
+    
+    def _stored_files(self):
+        """Names of every file currently under MEDIA_ROOT/uploads"""
+        upload_dir = os.path.join(settings.MEDIA_ROOT, 'uploads')
+        return sorted(os.listdir(upload_dir)) if os.path.isdir(upload_dir) else []
+
 
-class DeleteServiceTestCase(TestCase):
+@override_settings(PASSWORD_HASHERS=TEST_HASHERS)
+class DeleteServiceTestCase(TempMediaTestCase):
     """Test delete service functionality"""
     
     def setUp(self):
         self.test_content = b"test file content"
-        self.test_file = SimpleUploadedFile(
-            "test.txt",
-            self.test_content,
-            content_type="text/plain"
+        self.test_file = _uf("test.txt", self.test_content)
+        self.user_id = _user_id()
+    
+    def _create_files(self, references=0):
+        """Insert an original plus ``references`` references and matching UserStats"""
+        original = _make_file(self.user_id, self.test_content, reference_count=references)
+        rows = [original] + [
+            _make_file(self.user_id, self.test_content, is_reference=True,
+                       original=original, name=f"test{i + 2}.txt")
+            for i in range(references)
+        ]
+        File.objects.bulk_create(rows)
+        UserStats.objects.create(
+            user_id=self.user_id,
+            total_storage_used=len(self.test_content),
+            original_storage_used=len(self.test_content) * len(rows),
         )
-        self.user_id = "user1"
+        return rows
     
     def test_delete_reference(self):
         """Test deleting a reference file"""
-        # Create original and reference
-        original = handle_upload(self.user_id, self.test_file)
-        test_file2 = SimpleUploadedFile(
-            "test2.txt",
-            self.test_content,
-            content_type="text/plain"
-        )
-        reference = handle_upload(self.user_id, test_file2)
+        original, reference = self._create_files(references=1)
         
         # Delete reference
         delete_file(self.user_id, str(reference.id))
         
         # Reference should be gone, original should remain
-        self.assertFalse(File.objects.filter(id=reference.id).exists())
-        self.assertTrue(File.objects.filter(id=original.id).exists())
+        remaining = set(File.objects.filter(id__in=[reference.id, original.id]).values_list('id', flat=True))
+        self.assertEqual(remaining, {original.id})
         
         # Check stats updated
         stats = UserStats.objects.get(user_id=self.user_id)
         self.assertEqual(stats.original_storage_used, len(self.test_content))  # Only original remains
     
-    def test_delete_original_with_references(self):
-        """Test that deleting original with references raises ConflictError"""
-        # Create original
+    def test_reference_count_tracks_references(self):
+        """Test that reference_count on the original follows reference uploads and deletes"""
         original = handle_upload(self.user_id, self.test_file)
+        test_file2 = _uf("test2.txt", self.test_content)
+        other_user_id = _user_id()
+        reference = handle_upload(other_user_id, test_file2)
+        original.refresh_from_db()
+        self.assertEqual(original.reference_count, 1)
         
-        # Create reference
-        test_file2 = SimpleUploadedFile(
-            "test2.txt",
-            self.test_content,
-            content_type="text/plain"
-        )
-        handle_upload(self.user_id, test_file2)
+        delete_file(other_user_id, str(reference.id))
+        original.refresh_from_db()
+        self.assertEqual(original.reference_count, 0)
+    
+    def test_delete_original_with_references(self):
+        """Test that deleting original with references raises ConflictError"""
+        # The conflict check only looks at original_file_id, so bare rows suffice
+        original = File(original_filename="test.txt", file_type="text/plain", size=1,
+                        user_id=self.user_id, file_hash="h", reference_count=1)
+        File.objects.bulk_create([
+            original,
+            File(original_filename="test2.txt", file_type="text/plain", size=1,
+                 user_id=self.user_id, file_hash="h", is_reference=True, original_file=original),
+        ])
         
         # Try to delete original
         with self.assertRaises(ConflictError):
@@ -326,7 +506,7 @@ class DeleteServiceTestCase(TestCase):
     
     def test_delete_original_without_references(self):
         """Test deleting original without references"""
-        original = handle_upload(self.user_id, self.test_file)
+        original, = self._create_files()
         
         delete_file(self.user_id, str(original.id))
         
@@ -337,6 +517,18 @@ class DeleteServiceTestCase(TestCase):
         self.assertEqual(stats.total_storage_used, 0)
         self.assertEqual(stats.original_storage_used, 0)
     
+    def test_delete_original_removes_physical_file_on_commit(self):
+        """Test that the stored file is only removed once the deletion commits"""
+        original = handle_upload(self.user_id, self.test_file)
+        path = original.file.path
+        
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            delete_file(self.user_id, str(original.id))
+            self.assertTrue(os.path.exists(path))
+        
+        self.assertEqual(len(callbacks), 1)
+        self.assertFalse(os.path.exists(path))
+    
     def test_delete_nonexistent_file(self):
         """Test deleting non-existent file raises NotFound"""
         with self.assertRaises(NotFound):
@@ -348,69 +540,109 @@ class DeleteServiceTestCase(TestCase):
             delete_file("", "00000000-0000-0000-0000-000000000000")
 
 
-class SearchServiceTestCase(TestCase):
+@override_settings(PASSWORD_HASHERS=TEST_HASHERS)
+class SearchServiceTestCase(TempMediaTestCase):
     """Test search service functionality"""
     
-    def setUp(self):
-        self.user_id = "user1"
-        self.test_content = b"test content"
+    @classmethod
+    def setUpTestData(cls):
+        cls.user_id = _user_id()
+        cls.test_content = b"test content"
         
-        # Create test files
-        for i in range(5):
-            file_obj = SimpleUploadedFile(
-                f"test{i}.txt",
-                self.test_content,
-                content_type="text/plain"
+        # Search only reads metadata, so the rows need no stored content
+        cls.files = File.objects.bulk_create([
+            File(
+                user_id=cls.user_id,
+                original_filename=f"test{i}.txt",
+                file_type="text/plain",
+                size=len(cls.test_content),
+                file_hash=hashlib.sha256(f"test{i}".encode()).hexdigest(),
+                is_reference=False,
             )
-            handle_upload(self.user_id, file_obj)
+            for i in range(5)
+        ])
+        UserStats.objects.create(
+            user_id=cls.user_id,
+            total_storage_used=5 * len(cls.test_content),
+            original_storage_used=5 * len(cls.test_content),
+        )
     
     def test_search_all_files(self):
         """Test searching all files for user"""
-        files = search_files_for_user(self.user_id, {})
-        self.assertEqual(files.count(), 5)
+        ids = list(search_files_for_user(self.user_id, {}).values_list('id', flat=True))
+        self.assertCountEqual(ids, [f.id for f in self.files])
     
     def test_search_by_filename(self):
         """Test searching by filename"""
-        files = search_files_for_user(self.user_id, {"search": "test0"})
-        self.assertEqual(files.count(), 1)
-        self.assertIn("test0", files.first().original_filename)
+        files = list(search_files_for_user(self.user_id, {"search": "test0"}))
+        self.assertEqual(len(files), 1)
+        self.assertIn("test0", files[0].original_filename)
     
     def test_search_by_file_type(self):
         """Test searching by file type"""
-        files = search_files_for_user(self.user_id, {"file_type": "text/plain"})
-        self.assertEqual(files.count(), 5)
+        ids = list(search_files_for_user(self.user_id, {"file_type": "text/plain"}).values_list('id', flat=True))
+        self.assertCountEqual(ids, [f.id for f in self.files])
     
     def test_search_by_size_range(self):
         """Test searching by size range"""
-        files = search_files_for_user(self.user_id, {"min_size": 10, "max_size": 20})
-        self.assertEqual(files.count(), 5)
+        ids = list(search_files_for_user(self.user_id, {"min_size": 10, "max_size": 20}).values_list('id', flat=True))
+        self.assertCountEqual(ids, [f.id for f in self.files])
+    
+    def test_serializing_results_runs_no_extra_queries(self):
+        """Test that serializing search results doesn't fetch original files"""
+        File.objects.bulk_create([
+            _make_file(self.user_id, self.test_content, is_reference=True,
+                       original=self.files[0], name=f"dup{i}.txt")
+            for i in range(2)
+        ])
+        files = list(search_files_for_user(self.user_id, {}))
+        with self.assertNumQueries(0):
+            data = FileSerializer(files, many=True).data
+        self.assertEqual(sum(1 for row in data if row['original_file']), 2)
+    
+    def test_list_serializer_matches_file_serializer(self):
+        """Test that the fast list serializer produces the same rows as FileSerializer"""
+        # Include a stored original so download URLs are compared too
+        File.objects.bulk_create([_make_file(self.user_id, self.test_content, name="stored.txt")])
+        files = list(search_files_for_user(self.user_id, {}))
+        rows = FileSerializer(files, many=True).data
+        self.assertEqual(list(rows), [FileSerializer(f).data for f in files])
+        
+        values = list(search_files_for_user(self.user_id, {}).values(*LIST_VALUE_FIELDS))
+        self.assertEqual(list(FileSerializer(values, many=True).data), list(rows))
+    
+    def test_serializer_fields_built_once(self):
+        """Test that FileSerializer copies its cached fields rather than rebuilding them"""
+        FileSerializer().fields  # build the template
+        with patch('rest_framework.serializers.ModelSerializer.get_fields') as get_fields:
+            first, second = FileSerializer().fields, FileSerializer().fields
+        get_fields.assert_not_called()
+        self.assertEqual(list(first), list(LIST_VALUE_FIELDS))
+        self.assertIsNot(first['file'], second['file'])
+        self.assertIsInstance(first['file'].parent, FileSerializer)
     
     def test_distinct_file_types(self):
         """Test getting distinct file types"""
         types = distinct_file_types_for_user(self.user_id)
-        self.assertIn("text/plain", types)
+        self.assertEqual(list(types), ["text/plain"])
     
     def test_search_empty_user_id(self):
         """Test searching with empty user_id returns empty queryset"""
-        files = search_files_for_user("", {})
-        self.assertEqual(files.count(), 0)
+        self.assertEqual(list(search_files_for_user("", {})), [])
 
 
-class StatsServiceTestCase(TestCase):
+@override_settings(PASSWORD_HASHERS=TEST_HASHERS)
+class StatsServiceTestCase(TempMediaTestCase):
     """Test stats service functionality"""
     
     def setUp(self):
-        self.user_id = "user1"
+        self.user_id = _user_id()
         self.test_content = b"test content"
     
     def test_get_storage_stats(self):
         """Test getting storage stats"""
         # Upload file
-        test_file = SimpleUploadedFile(
-            "test.txt",
-            self.test_content,
-            content_type="text/plain"
-        )
+        test_file = _uf("test.txt", self.test_content)
         handle_upload(self.user_id, test_file)
         
         stats = get_storage_stats(self.user_id)
@@ -422,21 +654,17 @@ class StatsServiceTestCase(TestCase):
     
     def test_stats_with_deduplication(self):
         """Test stats with deduplication"""
-        # Upload original
-        test_file1 = SimpleUploadedFile(
-            "test1.txt",
-            self.test_content,
-            content_type="text/plain"
-        )
-        handle_upload(self.user_id, test_file1)
-        
-        # Upload duplicate (reference)
-        test_file2 = SimpleUploadedFile(
-            "test2.txt",
-            self.test_content,
-            content_type="text/plain"
+        original = _make_file(self.user_id, self.test_content, name="test1.txt", reference_count=1)
+        File.objects.bulk_create([
+            original,
+            _make_file(self.user_id, self.test_content, is_reference=True,
+                       original=original, name="test2.txt"),
+        ])
+        UserStats.objects.create(
+            user_id=self.user_id,
+            total_storage_used=len(self.test_content),
+            original_storage_used=len(self.test_content) * 2,
         )
-        handle_upload(self.user_id, test_file2)
         
         stats = get_storage_stats(self.user_id)
         self.assertEqual(stats["total_storage_used"], len(self.test_content))  # Only original
@@ -444,27 +672,56 @@ class StatsServiceTestCase(TestCase):
         self.assertEqual(stats["storage_savings"], len(self.test_content))  # Savings
         self.assertGreater(stats["savings_percentage"], 0)
     
+    def test_bump_user_stats(self):
+        """Test single-query stats updates with clamping and an optional total limit"""
+        self.assertTrue(bump_user_stats(self.user_id, original_delta=100, total_delta=100))
+        self.assertFalse(bump_user_stats(self.user_id, original_delta=50, total_delta=50, total_limit=120))
+        self.assertTrue(bump_user_stats(self.user_id, original_delta=-500, total_delta=-500))
+        
+        stats = UserStats.objects.get(user_id=self.user_id)
+        self.assertEqual(stats.total_storage_used, 0)
+        self.assertEqual(stats.original_storage_used, 0)
+    
     def test_stats_missing_user_id(self):
         """Test that missing user_id raises error"""
         with self.assertRaises(ValueError):
             get_storage_stats("")
 
 
-class APIViewTestCase(TestCase):
+# Endpoint behaviour only: no throttling (RateLimitingTestCase covers it, with
+# the real cache) and no middleware beyond the UserId check these tests assert.
+# throttle_classes is bound when DRF imports, so it is patched on the view.
+@patch.object(FileViewSet, 'throttle_classes', [])
+@override_settings(
+    CACHES={
+        alias: {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+        for alias in ('default', 'throttle')
+    },
+    MIDDLEWARE=['core.user_id_middleware.UserIdMiddleware'],
+)
+@override_settings(PASSWORD_HASHERS=TEST_HASHERS)
+class APIViewTestCase(TempMediaTestCase):
     """Test API endpoints"""
     
+    test_content = b"test file content"
+    
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.factory = APIRequestFactory()
+        cls.create_view = staticmethod(FileViewSet.as_view({'post': 'create'}))
+    
     def setUp(self):
         self.client = APIClient()
-        self.user_id = "user1"
-        self.test_content = b"test file content"
-        self.test_file = SimpleUploadedFile(
-            "test.txt",
-            self.test_content,
-            content_type="text/plain"
-        )
-        # Clear rate limit cache before each test
-        from django.core.cache import cache
-        cache.clear()
+        self.user_id = _user_id()
+        # Rebuilt per test: the upload's read position advances when it's posted
+        self.test_file = _uf("test.txt", self.test_content)
+    
+    def _upload(self):
+        """Upload self.test_file through FileViewSet.create, skipping URL routing and middleware"""
+        request = self.factory.post('/api/files/', {'file': self.test_file})
+        request.user_id = self.user_id  # normally attached by UserIdMiddleware
+        return self.create_view(request)
     
     def test_upload_file_success(self):
         """Test successful file upload"""
@@ -484,33 +741,55 @@ class APIViewTestCase(TestCase):
             {'file': self.test_file}
         )
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
-        # Parse JSON response
-        import json
-        data = json.loads(response.content)
-        self.assertIn('UserId header required', data['detail'])
+        self.assertIn('UserId header required', response.json()['detail'])
+    
+    def test_view_rejects_request_without_user_id(self):
+        """Test that FileViewSet answers 400 itself when no user id reaches it"""
+        response = self.create_view(self.factory.post('/api/files/', {'file': self.test_file}))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['detail'], 'UserId header required')
     
     def test_list_files(self):
         """Test listing files"""
         # Upload a file
-        self.client.post(
-            '/api/files/',
-            {'file': self.test_file},
-            HTTP_USERID=self.user_id
-        )
+        self._upload()
         
         # List files
         response = self.client.get('/api/files/', HTTP_USERID=self.user_id)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertGreaterEqual(len(response.data.get('results', response.data)), 1)
     
+    def test_list_files_query_count_is_flat(self):
+        """Test that listing references costs the same queries as listing one file"""
+        original = _make_file(self.user_id, reference_count=5)
+        original.save()
+        File.objects.bulk_create(
+            [_make_file(self.user_id, is_reference=True, original=original) for _ in range(5)]
+        )
+        
+        # One COUNT for the paginator and one SELECT for the page
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/files/', HTTP_USERID=self.user_id)
+        self.assertEqual(len(response.data['results']), 6)
+        self.assertEqual({row['original_file'] for row in response.data['results']} - {None}, {original.id})
+    
+    def test_list_files_streamed(self):
+        """Test that a streamed list page carries the same JSON as a rendered one"""
+        self._upload()
+        rendered = self.client.get('/api/files/', HTTP_USERID=self.user_id)
+        
+        with override_settings(FILE_VAULT_STREAM_LIST_RESPONSES=True):
+            response = self.client.get('/api/files/', HTTP_USERID=self.user_id)
+        
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertIn('ETag', response)
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), rendered.json())
+    
     def test_get_file_details(self):
         """Test getting file details"""
         # Upload file
-        upload_response = self.client.post(
-            '/api/files/',
-            {'file': self.test_file},
-            HTTP_USERID=self.user_id
-        )
+        upload_response = self._upload()
         file_id = upload_response.data['id']
         
         # Get file details
@@ -521,11 +800,7 @@ class APIViewTestCase(TestCase):
     def test_delete_file(self):
         """Test deleting a file"""
         # Upload file
-        upload_response = self.client.post(
-            '/api/files/',
-            {'file': self.test_file},
-            HTTP_USERID=self.user_id
-        )
+        upload_response = self._upload()
         file_id = upload_response.data['id']
         
         # Delete file
@@ -536,14 +811,17 @@ class APIViewTestCase(TestCase):
         get_response = self.client.get(f'/api/files/{file_id}/', HTTP_USERID=self.user_id)
         self.assertEqual(get_response.status_code, status.HTTP_404_NOT_FOUND)
     
+    def test_json_only_actions_ignore_accept(self):
+        """Test that storage_stats and file_types answer JSON even when HTML is asked for"""
+        for path in ('/api/files/storage_stats/', '/api/files/file_types/'):
+            response = self.client.get(path, HTTP_USERID=self.user_id, HTTP_ACCEPT='text/html')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['Content-Type'], 'application/json')
+    
     def test_storage_stats_endpoint(self):
         """Test storage stats endpoint"""
         # Upload file
-        self.client.post(
-            '/api/files/',
-            {'file': self.test_file},
-            HTTP_USERID=self.user_id
-        )
+        self._upload()
         
         # Get stats
         response = self.client.get('/api/files/storage_stats/', HTTP_USERID=self.user_id)
@@ -555,19 +833,8 @@ class APIViewTestCase(TestCase):
     
     def test_file_types_endpoint(self):
         """Test file types endpoint"""
-        # Wait a bit to avoid rate limiting
-        import time
-        time.sleep(0.6)
-        
         # Upload file
-        self.client.post(
-            '/api/files/',
-            {'file': self.test_file},
-            HTTP_USERID=self.user_id
-        )
-        
-        # Wait a bit more to avoid rate limiting
-        time.sleep(0.6)
+        self._upload()
         
         # Get file types
         response = self.client.get('/api/files/file_types/', HTTP_USERID=self.user_id)
@@ -575,15 +842,12 @@ class APIViewTestCase(TestCase):
         self.assertIsInstance(response.data, list)
         self.assertIn('text/plain', response.data)
     
+    @_skip_hashing
     def test_upload_file_over_10mb_via_api(self):
         """Test uploading file over 10MB via API returns 429"""
         quota_bytes = 10 * 1024 * 1024  # 10MB
-        large_content = b"x" * (quota_bytes + 1024 * 1024)  # 11MB
-        large_file = SimpleUploadedFile(
-            "large_11mb.txt",
-            large_content,
-            content_type="text/plain"
-        )
+        large_content = _payload(quota_bytes + MB)  # 11MB
+        large_file = _mem_file(large_content, "large_11mb.txt")
         
         response = self.client.post(
             '/api/files/',
@@ -592,10 +856,7 @@ class APIViewTestCase(TestCase):
         )
         
         self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
-        # Parse JSON response
-        import json
-        data = json.loads(response.content)
-        self.assertIn('Storage Quota Exceeded', data['detail'])
+        self.assertIn('Storage Quota Exceeded', response.json()['detail'])
     
     def test_upload_file_no_file_field(self):
         """Test uploading without file field returns 400"""
@@ -607,13 +868,10 @@ class APIViewTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertIn('No file provided', response.data['detail'])
     
+    @_skip_hashing
     def test_upload_empty_file_via_api(self):
         """Test uploading empty file via API"""
-        empty_file = SimpleUploadedFile(
-            "empty.txt",
-            b"",
-            content_type="text/plain"
-        )
+        empty_file = _uf("empty.txt", b"")
         response = self.client.post(
             '/api/files/',
             {'file': empty_file},
@@ -622,15 +880,12 @@ class APIViewTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(response.data['size'], 0)
     
+    @_skip_hashing
     def test_upload_file_exactly_10mb_via_api(self):
         """Test uploading file exactly at 10MB quota via API"""
         quota_bytes = 10 * 1024 * 1024  # 10MB
-        exact_content = b"x" * quota_bytes
-        exact_file = SimpleUploadedFile(
-            "exact_10mb.txt",
-            exact_content,
-            content_type="text/plain"
-        )
+        exact_content = _payload(quota_bytes)
+        exact_file = _mem_file(exact_content, "exact_10mb.txt")
         
         response = self.client.post(
             '/api/files/',
@@ -641,12 +896,13 @@ class APIViewTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(response.data['size'], quota_bytes)
     
+    @_skip_hashing
     def test_upload_multiple_files_until_quota_via_api(self):
         """Test uploading multiple files until quota is reached via API"""
         # Upload first file (5MB)
         file1_size = 5 * 1024 * 1024
-        file1_content = b"x" * file1_size
-        file1 = SimpleUploadedFile("file1.txt", file1_content, content_type="text/plain")
+        file1_content = _payload(file1_size)
+        file1 = _uf("file1.txt", file1_content)
         
         response1 = self.client.post(
             '/api/files/',
@@ -657,11 +913,8 @@ class APIViewTestCase(TestCase):
         
         # Upload second file (4MB) - should succeed
         file2_size = 4 * 1024 * 1024
-        file2_content = b"y" * file2_size
-        file2 = SimpleUploadedFile("file2.txt", file2_content, content_type="text/plain")
-        
-        import time
-        time.sleep(0.6)  # Avoid rate limit
+        file2_content = _payload(file2_size, b"y")
+        file2 = _uf("file2.txt", file2_content)
         
         response2 = self.client.post(
             '/api/files/',
@@ -672,10 +925,8 @@ class APIViewTestCase(TestCase):
         
         # Upload third file (2MB) - should fail (11MB total)
         file3_size = 2 * 1024 * 1024
-        file3_content = b"z" * file3_size
-        file3 = SimpleUploadedFile("file3.txt", file3_content, content_type="text/plain")
-        
-        time.sleep(0.6)  # Avoid rate limit
+        file3_content = _payload(file3_size, b"z")
+        file3 = _uf("file3.txt", file3_content)
         
         response3 = self.client.post(
             '/api/files/',
@@ -683,11 +934,10 @@ class APIViewTestCase(TestCase):
             HTTP_USERID=self.user_id
         )
         self.assertEqual(response3.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
-        import json
-        data = json.loads(response3.content)
-        self.assertIn('Storage Quota Exceeded', data['detail'])
+        self.assertIn('Storage Quota Exceeded', response3.json()['detail'])
 
 
+@override_settings(PASSWORD_HASHERS=TEST_HASHERS)
 class MiddlewareTestCase(TestCase):
     """Test middleware functionality"""
     
@@ -708,28 +958,162 @@ class MiddlewareTestCase(TestCase):
     
     def test_userid_middleware_with_header(self):
         """Test that UserId middleware accepts valid header"""
-        response = self.client.get('/api/files/', HTTP_USERID='user1')
+        response = self.client.get('/api/files/', HTTP_USERID=_user_id())
         # Should not return 400 (might be 200 with empty results)
         self.assertNotEqual(response.status_code, 400)
+    
+    def test_userid_middleware_sets_context_var(self):
+        """Test that the user id is visible through current_user_id only during the request"""
+        seen = []
+        request = RequestFactory().get('/api/files/', HTTP_USERID='ctx-user')
+        middleware = UserIdMiddleware(lambda r: seen.append(current_user_id.get()) or HttpResponse())
+        middleware(request)
+        self.assertEqual(seen, ['ctx-user'])
+        self.assertIsNone(current_user_id.get())
 
 
+class LoggingConfigTestCase(TestCase):
+    """Test the handlers settings.LOGGING sets up"""
+    
+    def test_loggers_enqueue_records(self):
+        """Test that app loggers hand records to the QueueListener instead of writing them"""
+        for name in ('', 'django', 'files'):
+            handlers = logging.getLogger(name).handlers
+            self.assertEqual([type(h) for h in handlers], [logging.handlers.QueueHandler], name)
+        
+        listener = logging_config._queue_listener
+        self.assertIs(logging.getLogger().handlers[0].queue, listener.queue)
+        self.assertIsNotNone(listener._thread)
+        
+        buffer = listener.handlers[0]
+        self.assertIsInstance(buffer, logging_config.PeriodicMemoryHandler)
+        self.assertEqual((buffer.capacity, buffer.flushLevel), (512, logging.ERROR))
+        self.assertIsInstance(buffer.target, logging.StreamHandler)
+
+
+@override_settings(PASSWORD_HASHERS=TEST_HASHERS)
+class SpaIndexTestCase(TestCase):
+    """Test SPA index view caching"""
+    
+    def setUp(self):
+        self.static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.static_root, ignore_errors=True)
+        with open(os.path.join(self.static_root, 'index.html'), 'wb') as f:
+            f.write(b"<html>v1</html>")
+    
+    def test_index_served_with_etag(self):
+        """Test that index.html is served with an ETag and honours If-None-Match"""
+        with override_settings(STATIC_ROOT=self.static_root):
+            response = self.client.get('/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, b"<html>v1</html>")
+            etag = response['ETag']
+            
+            response = self.client.get('/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+    
+    def test_index_reloaded_when_changed(self):
+        """Test that a rebuilt index.html replaces the cached copy"""
+        index_path = os.path.join(self.static_root, 'index.html')
+        with override_settings(STATIC_ROOT=self.static_root):
+            first = self.client.get('/')
+            with open(index_path, 'wb') as f:
+                f.write(b"<html>v2</html>")
+            os.utime(index_path, ns=(0, os.stat(index_path).st_mtime_ns + 1))
+            second = self.client.get('/', HTTP_IF_NONE_MATCH=first['ETag'])
+            self.assertEqual(second.status_code, 200)
+            self.assertEqual(second.content, b"<html>v2</html>")
+
+
+@patch.object(FileViewSet, 'throttle_classes', [])
+@override_settings(PASSWORD_HASHERS=TEST_HASHERS)
+class ResponseCacheTestCase(TempMediaTestCase):
+    """Test per-user caching of the stats and file type endpoints"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.user_id = _user_id()
+        self.addCleanup(cache.clear)
+    
+    def test_storage_stats_cached_until_upload(self):
+        """Test that repeated stats requests skip the database until the user uploads"""
+        first = self.client.get('/api/files/storage_stats/', HTTP_USERID=self.user_id)
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/files/storage_stats/', HTTP_USERID=self.user_id)
+        self.assertEqual(second.data, first.data)
+        
+        content = b"test file content"
+        self.client.post('/api/files/', {'file': _uf("test.txt", content)}, HTTP_USERID=self.user_id)
+        third = self.client.get('/api/files/storage_stats/', HTTP_USERID=self.user_id)
+        self.assertEqual(third.data['total_storage_used'], len(content))
+    
+    def test_stats_computed_before_upload_not_served_after(self):
+        """Test that stats stored late by a reader that raced an upload can't be served under the new ETag"""
+        stale_key = views._stats_cache_key(self.user_id)
+        stale = self.client.get('/api/files/storage_stats/', HTTP_USERID=self.user_id).data
+        
+        self.client.post('/api/files/', {'file': _uf("race.txt", uuid4().bytes)}, HTTP_USERID=self.user_id)
+        cache.set(stale_key, stale)  # the racing reader's late write
+        response = self.client.get('/api/files/storage_stats/', HTTP_USERID=self.user_id)
+        self.assertEqual(response.data['total_storage_used'], 16)
+    
+    def test_file_types_cached_until_delete(self):
+        """Test that the cached file types are dropped when the user deletes a file"""
+        upload = self.client.post('/api/files/', {'file': _uf()}, HTTP_USERID=self.user_id)
+        response = self.client.get('/api/files/file_types/', HTTP_USERID=self.user_id)
+        self.assertEqual(response.data, ['text/plain'])
+        
+        self.client.delete(f"/api/files/{upload.data['id']}/", HTTP_USERID=self.user_id)
+        response = self.client.get('/api/files/file_types/', HTTP_USERID=self.user_id)
+        self.assertEqual(response.data, [])
+    
+    def test_list_not_modified_until_upload(self):
+        """Test that list answers 304 for a matching ETag until the user's files change"""
+        first = self.client.get('/api/files/', HTTP_USERID=self.user_id)
+        etag = first['ETag']
+        
+        response = self.client.get('/api/files/', HTTP_USERID=self.user_id, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        other_query = self.client.get('/api/files/?search=x', HTTP_USERID=self.user_id, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(other_query.status_code, status.HTTP_200_OK)
+        
+        self.client.post('/api/files/', {'file': _uf()}, HTTP_USERID=self.user_id)
+        response = self.client.get('/api/files/', HTTP_USERID=self.user_id, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 1)
+    
+    def test_list_etag_changes_when_another_user_references_original(self):
+        """Test that the owner's ETag goes stale when a duplicate changes their reference_count"""
+        content = uuid4().bytes
+        self.client.post('/api/files/', {'file': _uf("a.txt", content)}, HTTP_USERID=self.user_id)
+        etag = self.client.get('/api/files/', HTTP_USERID=self.user_id)['ETag']
+        
+        other_user = _user_id()
+        reference = self.client.post('/api/files/', {'file': _uf("b.txt", content)}, HTTP_USERID=other_user)
+        response = self.client.get('/api/files/', HTTP_USERID=self.user_id, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['reference_count'], 1)
+        
+        self.client.delete(f"/api/files/{reference.data['id']}/", HTTP_USERID=other_user)
+        response = self.client.get('/api/files/', HTTP_USERID=self.user_id, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['reference_count'], 0)
+
+
+@override_settings(PASSWORD_HASHERS=TEST_HASHERS)
 class RateLimitingTestCase(TestCase):
     """Test rate limiting functionality"""
     
     def setUp(self):
         self.client = APIClient()
-        self.user_id = "user1"
+        self.user_id = _user_id()
         self.test_content = b"test content"
-        self.test_file = SimpleUploadedFile(
-            "test.txt",
-            self.test_content,
-            content_type="text/plain"
-        )
+        self.test_file = _uf("test.txt", self.test_content)
     
     def test_rate_limit_enforcement(self):
         """Test that rate limiting is enforced"""
         # Make requests rapidly to trigger rate limit
-        with patch('files.throttling.settings.FILE_VAULT_RATE_LIMIT_CALLS', 2):
+        with override_settings(FILE_VAULT_RATE_LIMIT_CALLS=2):
             # First two requests should succeed
             response1 = self.client.get('/api/files/', HTTP_USERID=self.user_id)
             response2 = self.client.get('/api/files/', HTTP_USERID=self.user_id)
@@ -745,7 +1129,7 @@ class RateLimitingTestCase(TestCase):
     
     def test_rate_limit_message(self):
         """Test that rate limit returns correct message"""
-        with patch('files.throttling.settings.FILE_VAULT_RATE_LIMIT_CALLS', 1):
+        with override_settings(FILE_VAULT_RATE_LIMIT_CALLS=1):
             # Make first request
             self.client.get('/api/files/', HTTP_USERID=self.user_id)
             
@@ -753,4 +1137,74 @@ class RateLimitingTestCase(TestCase):
             response = self.client.get('/api/files/', HTTP_USERID=self.user_id)
             if response.status_code == status.HTTP_429_TOO_MANY_REQUESTS:
                 self.assertEqual(response.data['detail'], 'Call Limit Reached')
-
+    
+    @override_settings(FILE_VAULT_RATE_LIMIT_CALLS=2, FILE_VAULT_RATE_LIMIT_WINDOW=1)
+    def test_redis_sliding_window_script(self):
+        """Test that a Redis cache checks the window with one script call per request"""
+        calls = []
+        
+        class FakeRedis:
+            def register_script(self, lua):
+                def script(keys, args, client):
+                    calls.append((keys, args))
+                    return 1 if len(calls) <= 2 else 0
+                return script
+        
+        with patch('files.throttling._redis_client', return_value=FakeRedis()), \
+                patch('files.throttling._sliding_window_script', None):
+            codes = [self.client.get('/api/files/', HTTP_USERID=self.user_id).status_code for _ in range(3)]
+        
+        self.assertEqual(codes, [200, 200, 429])
+        self.assertEqual(len(calls), 3)
+        keys, args = calls[0]
+        self.assertTrue(keys[0].endswith(':' + UserIdRateThrottle().cache_key_for_user(self.user_id)))
+        self.assertEqual(args[1:4], [0.1, 10, 2])  # bucket width, buckets, calls allowed
+    
+    def test_redis_denial_short_circuits(self):
+        """Test that a just-throttled user is rejected again without calling Redis"""
+        calls = []
+        
+        class FakeRedis:
+            def register_script(self, lua):
+                def script(keys, args, client):
+                    calls.append(keys)
+                    return 0
+                return script
+        
+        with patch('files.throttling._redis_client', return_value=FakeRedis()), \
+                patch('files.throttling._sliding_window_script', None), \
+                patch.dict('files.throttling._deny_until', clear=True):
+            codes = [self.client.get('/api/files/', HTTP_USERID=self.user_id).status_code for _ in range(2)]
+        
+        self.assertEqual(codes, [429, 429])
+        self.assertEqual(len(calls), 1)
+    
+    def test_redis_batched_checks_use_pipeline(self):
+        """Test that FILE_VAULT_THROTTLE_BATCHING sends script calls through a pipeline"""
+        executed = []
+        
+        class FakePipeline:
+            def __init__(self):
+                self.queued = []
+            
+            def execute(self):
+                executed.append(len(self.queued))
+                return [1] * len(self.queued)
+        
+        class FakeRedis:
+            def register_script(self, lua):
+                def script(keys, args, client):
+                    client.queued.append((keys, args))
+                return script
+            
+            def pipeline(self, transaction=True):
+                return FakePipeline()
+        
+        with override_settings(FILE_VAULT_THROTTLE_BATCHING=True), \
+                patch('files.throttling._redis_client', return_value=FakeRedis()), \
+                patch('files.throttling._sliding_window_script', None), \
+                patch('files.throttling._script_batcher', None):
+            response = self.client.get('/api/files/', HTTP_USERID=self.user_id)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(executed, [1])
@@ -2,30 +2,203 @@
 Rate throttling for API requests based on user ID.
 
 This module implements per-user rate limiting using Django REST Framework's
-throttling mechanism.
+throttling mechanism. Windows are kept in the dedicated "throttle" cache; when
+that cache is Redis, a bucketed sliding window is checked and updated
+atomically in Redis with a single script call.
 """
 
+import concurrent.futures
 import logging
+import queue
+import threading
+import math
+import time
 from typing import Optional
 from rest_framework.throttling import SimpleRateThrottle
 from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from files.constants import (
     DEFAULT_RATE_LIMIT_CALLS,
     DEFAULT_RATE_LIMIT_WINDOW_SECONDS,
     RATE_LIMIT_CACHE_PREFIX,
+    THROTTLE_CACHE_ALIAS,
+    THROTTLE_BATCH_MAX_SIZE,
+    THROTTLE_BATCH_WINDOW_SECONDS,
+    THROTTLE_DENY_CACHE_MAX_SIZE,
+    THROTTLE_DENY_CACHE_SECONDS,
+    THROTTLE_WINDOW_BUCKETS,
 )
+from files.utils import get_request_user_id
 
 logger = logging.getLogger(__name__)
 
+_USER_KEY_PREFIX = RATE_LIMIT_CACHE_PREFIX + "_"
+
+# DRF rate units for the window lengths it can express; anything else is
+# treated as seconds
+_WINDOW_UNIT = {1: "second", 60: "minute", 3600: "hour", 86400: "day"}
+
+# Sliding window kept as a hash of bucket number -> request count, where a
+# bucket is ARGV[2] seconds wide and the window spans the last ARGV[3] buckets.
+# Buckets that fell out of the window are dropped; the request is counted only
+# if the remaining total is under the limit. State stays at most ARGV[3] small
+# fields per user however high the limit is. Returns 1 if the request is
+# allowed, 0 if throttled.
+_SLIDING_WINDOW_LUA = """
+local key = KEYS[1]
+local bucket = math.floor(tonumber(ARGV[1]) / tonumber(ARGV[2]))
+local oldest = bucket - tonumber(ARGV[3]) + 1
+local total = 0
+local fields = redis.call('HGETALL', key)
+for i = 1, #fields, 2 do
+    if tonumber(fields[i]) < oldest then
+        redis.call('HDEL', key, fields[i])
+    else
+        total = total + tonumber(fields[i + 1])
+    end
+end
+if total >= tonumber(ARGV[4]) then
+    return 0
+end
+redis.call('HINCRBY', key, bucket, 1)
+redis.call('EXPIRE', key, ARGV[5])
+return 1
+"""
+
+# redis-py Script for _SLIDING_WINDOW_LUA, registered on first use; it runs
+# via EVALSHA and reloads itself if Redis has flushed its script cache
+_sliding_window_script = None
+
+# Redis key -> time until which this process rejects it without asking Redis,
+# set whenever the script throttles a request
+_deny_until = {}
+
+# _ScriptBatcher shared by all request threads when FILE_VAULT_THROTTLE_BATCHING is on
+_script_batcher = None
+_script_batcher_lock = threading.Lock()
+
+
+def _redis_client():
+    """
+    Get the redis-py client behind the throttle cache.
+    
+    Returns:
+        The client, or None if the throttle cache isn't Django's RedisCache
+    """
+    backend = caches[THROTTLE_CACHE_ALIAS]
+    if not isinstance(backend, RedisCache):
+        return None
+    return backend._cache.get_client(write=True)
+
+
+class _ScriptBatcher:
+    """
+    Runs sliding-window checks queued by many request threads in one pipeline.
+    
+    A background thread waits up to THROTTLE_BATCH_WINDOW_SECONDS for more
+    checks after the first one arrives, then sends up to
+    THROTTLE_BATCH_MAX_SIZE script calls in a single round trip. Each script
+    call is still atomic on its own, so the pipeline needs no MULTI/EXEC.
+    """
+
+    def __init__(self, client, script):
+        self._client = client
+        self._script = script
+        self._queue = queue.SimpleQueue()
+        thread = threading.Thread(target=self._run, name="throttle-batcher", daemon=True)
+        thread.start()
+
+    def check(self, key: str, args: list):
+        """
+        Queue one script call and wait for its result.
+        
+        Args:
+            key: Redis key of the user's sliding window
+            args: Script arguments (now, bucket width, bucket count, limit, TTL)
+            
+        Returns:
+            The script's return value (1 if allowed, 0 if throttled)
+        """
+        future = concurrent.futures.Future()
+        self._queue.put((key, args, future))
+        return future.result()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + THROTTLE_BATCH_WINDOW_SECONDS
+            while len(batch) < THROTTLE_BATCH_MAX_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                pipe = self._client.pipeline(transaction=False)
+                for key, args, _ in batch:
+                    self._script(keys=[key], args=args, client=pipe)
+                results = pipe.execute()
+            except Exception as e:
+                logger.warning("Batched throttle check failed: %s", e)
+                for _, _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, _, future), result in zip(batch, results):
+                    future.set_result(result)
+
+
+def _remember_denial(redis_key: str, until: float) -> None:
+    """
+    Reject redis_key locally until the given time.
+    
+    A client hammering the API after being throttled is turned away without
+    a Redis round trip. Expired entries are dropped once the map grows past
+    THROTTLE_DENY_CACHE_MAX_SIZE.
+    
+    Args:
+        redis_key: Full Redis key of the throttled user's window
+        until: timer() value after which Redis is consulted again
+    """
+    if len(_deny_until) >= THROTTLE_DENY_CACHE_MAX_SIZE:
+        now = time.time()
+        # list() copies the items in one step, so other request threads adding
+        # denials can't change the dict's size mid-iteration
+        for stale, expiry in list(_deny_until.items()):
+            if expiry <= now:
+                _deny_until.pop(stale, None)
+    _deny_until[redis_key] = until
+
+
+def _get_script_batcher(client, script) -> _ScriptBatcher:
+    """Return the process-wide _ScriptBatcher, starting it on first use."""
+    global _script_batcher
+    if _script_batcher is None:
+        with _script_batcher_lock:
+            if _script_batcher is None:
+                _script_batcher = _ScriptBatcher(client, script)
+    return _script_batcher
+
 
 class UserIdRateThrottle(SimpleRateThrottle):
     """
     Rate throttle based on user ID.
     
     Limits requests per user according to configured rate limits.
-    Uses Django's cache to track request counts per user.
+    Uses the "throttle" cache alias to track request counts per user.
     """
     scope = "user_id"
+    # Rate string built from settings on first use; reset by setting_changed
+    _cached_rate = None
+
+    @property
+    def cache(self):
+        """The throttle cache, looked up per use so override_settings(CACHES=...) applies."""
+        return caches[THROTTLE_CACHE_ALIAS]
 
     def get_cache_key(self, request, view) -> Optional[str]:
         """
@@ -38,7 +211,7 @@ class UserIdRateThrottle(SimpleRateThrottle):
         Returns:
             Cache key string, or None if user_id is not available
         """
-        user_id = getattr(request, "user_id", None)
+        user_id = get_request_user_id(request)
         if not user_id:
             return None
         return self.cache_key_for_user(user_id)
@@ -53,29 +226,77 @@ class UserIdRateThrottle(SimpleRateThrottle):
         Returns:
             Cache key string
         """
-        return f"{RATE_LIMIT_CACHE_PREFIX}_{user_id}"
+        return _USER_KEY_PREFIX + user_id
 
-    def get_rate(self) -> str:
+    def allow_request(self, request, view) -> bool:
         """
-        Get rate limit string from settings.
+        Check whether the request fits in the user's sliding window.
+        
+        With a Redis cache the check and the update happen in one atomic
+        script call, so concurrent workers can't both take the last slot.
+        FILE_VAULT_THROTTLE_BATCHING sends concurrent calls from one process
+        as a single pipeline instead. Other caches use DRF's get-then-set
+        history list.
         
+        Args:
+            request: The HTTP request object
+            view: The view being accessed
+            
         Returns:
-            Rate limit string in format "calls/unit" (e.g., "2/second")
+            True if the request is allowed, False if it is throttled
         """
-        calls = getattr(settings, "FILE_VAULT_RATE_LIMIT_CALLS", DEFAULT_RATE_LIMIT_CALLS)
-        window = int(getattr(settings, "FILE_VAULT_RATE_LIMIT_WINDOW", DEFAULT_RATE_LIMIT_WINDOW_SECONDS))
+        client = _redis_client()
+        if client is None:
+            return super().allow_request(request, view)
+        if self.rate is None:
+            return True
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+        
+        self.now = self.timer()
+        # The window lives in Redis; wait() only needs an empty local history
+        self.history = []
+        redis_key = self.cache.make_key(key)
+        if _deny_until.get(redis_key, 0) > self.now:
+            return False
         
-        # DRF supports units: second(s)/minute(s)/hour(s)/day(s)
-        if window == 1:
-            unit = "second"
-        elif window == 60:
-            unit = "minute"
-        elif window == 3600:
-            unit = "hour"
-        elif window == 86400:
-            unit = "day"
+        global _sliding_window_script
+        if _sliding_window_script is None:
+            _sliding_window_script = client.register_script(_SLIDING_WINDOW_LUA)
+        args = [
+            self.now,
+            self.duration / THROTTLE_WINDOW_BUCKETS,
+            THROTTLE_WINDOW_BUCKETS,
+            self.num_requests,
+            math.ceil(self.duration) + 1,
+        ]
+        if getattr(settings, "FILE_VAULT_THROTTLE_BATCHING", False):
+            allowed = _get_script_batcher(client, _sliding_window_script).check(redis_key, args)
         else:
-            unit = "second"
+            allowed = _sliding_window_script(keys=[redis_key], args=args, client=client)
+        if not allowed:
+            _remember_denial(redis_key, self.now + min(THROTTLE_DENY_CACHE_SECONDS, self.duration / 2))
+        return bool(allowed)
+
+    def get_rate(self) -> str:
+        """
+        Get rate limit string from settings, computed once and then cached.
         
-        return f"{calls}/{unit}"
+        Returns:
+            Rate limit string in format "calls/unit" (e.g., "2/second")
+        """
+        cls = UserIdRateThrottle
+        if cls._cached_rate is None:
+            calls = getattr(settings, "FILE_VAULT_RATE_LIMIT_CALLS", DEFAULT_RATE_LIMIT_CALLS)
+            window = int(getattr(settings, "FILE_VAULT_RATE_LIMIT_WINDOW", DEFAULT_RATE_LIMIT_WINDOW_SECONDS))
+            # DRF supports units: second(s)/minute(s)/hour(s)/day(s)
+            cls._cached_rate = f"{calls}/{_WINDOW_UNIT.get(window, 'second')}"
+        return cls._cached_rate
+
 
+@receiver(setting_changed)
+def _reset_cached_rate(setting, **kwargs):
+    """Rebuild the rate on next use when a test overrides the rate limit settings."""
+    if setting in ("FILE_VAULT_RATE_LIMIT_CALLS", "FILE_VAULT_RATE_LIMIT_WINDOW"):
+        UserIdRateThrottle._cached_rate = None
@@ -4,18 +4,30 @@ Utility functions for the File Vault application.
 This module contains shared utility functions used across services.
 """
 
+import functools
 import logging
+from contextvars import ContextVar
 from typing import Optional
 from django.conf import settings
 from django.core.files.uploadedfile import UploadedFile
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
 logger = logging.getLogger(__name__)
 
+# User ID of the API request being handled, set by UserIdMiddleware for the
+# duration of the request
+current_user_id: ContextVar[Optional[str]] = ContextVar("current_user_id", default=None)
 
+
+@functools.lru_cache(maxsize=1)
 def get_storage_quota_bytes() -> int:
     """
     Get the storage quota in bytes from settings.
     
+    The value is cached for the life of the process and recomputed when
+    ``override_settings`` changes FILE_VAULT_STORAGE_QUOTA_MB.
+    
     Returns:
         int: Storage quota in bytes (default: 10 MB)
     """
@@ -23,6 +35,30 @@ def get_storage_quota_bytes() -> int:
     return int(quota_mb) * 1024 * 1024
 
 
+@receiver(setting_changed)
+def _reset_storage_quota(setting, **kwargs):
+    """Drop the cached quota when a test overrides FILE_VAULT_STORAGE_QUOTA_MB."""
+    if setting == 'FILE_VAULT_STORAGE_QUOTA_MB':
+        get_storage_quota_bytes.cache_clear()
+
+
+def get_request_user_id(request) -> Optional[str]:
+    """
+    Get the user ID of the request being handled.
+    
+    Reads ``current_user_id`` first, which avoids going through DRF's Request
+    attribute proxy. Requests that didn't pass through UserIdMiddleware (e.g.
+    views called directly) fall back to ``request.user_id``.
+    
+    Args:
+        request: The HTTP or DRF request object
+        
+    Returns:
+        The user ID, or None if the request has none
+    """
+    return current_user_id.get() or getattr(request, "user_id", None)
+
+
 def validate_user_id(user_id: Optional[str]) -> None:
     """
     Validate that user_id is provided and not empty.
@@ -47,7 +83,10 @@ def get_file_size(uploaded_file: UploadedFile) -> int:
     Returns:
         int: File size in bytes (0 if not available)
     """
-    return getattr(uploaded_file, 'size', 0) or 0
+    try:
+        return uploaded_file.size or 0
+    except AttributeError:
+        return 0
 
 
 def get_file_type(uploaded_file: UploadedFile) -> str:
@@ -60,7 +99,10 @@ def get_file_type(uploaded_file: UploadedFile) -> str:
     Returns:
         str: MIME type (empty string if not available)
     """
-    return getattr(uploaded_file, 'content_type', '') or ''
+    try:
+        return uploaded_file.content_type or ''
+    except AttributeError:
+        return ''
 
 
 def get_original_filename(uploaded_file: UploadedFile) -> str:
@@ -73,5 +115,8 @@ def get_original_filename(uploaded_file: UploadedFile) -> str:
     Returns:
         str: Original filename (empty string if not available)
     """
-    return getattr(uploaded_file, 'name', '') or ''
+    try:
+        return uploaded_file.name or ''
+    except AttributeError:
+        return ''
 
@@ -5,27 +5,134 @@ This module provides REST API endpoints for file operations,
 delegating business logic to service layer functions.
 """
 
+import hashlib
 import logging
+import time
+import orjson
+from django.conf import settings
+from django.core.cache import cache
+from django.http import StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from drf_orjson_renderer.renderers import ORJSONRenderer
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.generics import get_object_or_404
 from .models import File
-from .serializers import FileSerializer
+from .permissions import HasUserId
+from .serializers import FileSerializer, LIST_VALUE_FIELDS
 from .services.upload_service import handle_upload
 from .services.delete_service import delete_file
 from .services.search_service import search_files_for_user, distinct_file_types_for_user
 from .services.stats_service import get_storage_stats
+from .utils import get_request_user_id
 from .constants import (
     ERROR_USER_ID_REQUIRED,
     ERROR_NO_FILE_PROVIDED,
+    STATS_CACHE_PREFIX,
+    STATS_CACHE_TTL_SECONDS,
+    FILE_TYPES_CACHE_PREFIX,
+    FILE_TYPES_CACHE_TTL_SECONDS,
+    FILES_VERSION_PREFIX,
 )
 
 logger = logging.getLogger(__name__)
 
+# Actions that only ever answer JSON, and the renderer they all share, so
+# they skip content negotiation
+_JSON_ONLY_ACTIONS = frozenset({'storage_stats', 'file_types'})
+_JSON_RENDERER = ORJSONRenderer()
+
+
+def _files_version_key(user_id: str) -> str:
+    return f"{FILES_VERSION_PREFIX}:{user_id}"
+
+
+def _files_version(user_id: str) -> int:
+    """
+    Current version of the user's files, changed by every upload or delete.
+    
+    Versions start from the clock rather than 1, so a counter lost to cache
+    eviction never comes back with a value an old ETag or entry used.
+    """
+    return cache.get_or_set(_files_version_key(user_id), time.time_ns, None)
+
+
+def _stats_cache_key(user_id: str) -> str:
+    """
+    Key of the user's current stats entry; older versions just expire.
+    
+    Versioned like the ETag, so a body computed before an upload or delete
+    can't be stored where requests under the new version will read it.
+    """
+    return f"{STATS_CACHE_PREFIX}:{user_id}:v{_files_version(user_id)}"
+
+
+def _file_types_cache_key(user_id: str) -> str:
+    """Key of the user's current file types entry; older versions just expire."""
+    return f"{FILE_TYPES_CACHE_PREFIX}:{user_id}:v{_files_version(user_id)}"
+
+
+def _files_etag(request, *args, **kwargs) -> str:
+    """ETag for GETs that depend only on the user's files and the query string."""
+    user_id = get_request_user_id(request)
+    token = f"{user_id}:{_files_version(user_id)}:{request.get_full_path()}"
+    return hashlib.md5(token.encode()).hexdigest()
+
+
+def _bump_files_version(user_id: str) -> None:
+    """
+    Move the user to a new files version after their files change.
+    
+    Their ETags and cached stats and file types entries all go stale. Also
+    needed when another user's upload or delete changes the reference_count
+    of one of this user's originals.
+    """
+    version_key = _files_version_key(user_id)
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        # No version stored yet (or it was evicted); start a fresh one
+        cache.set(version_key, time.time_ns(), None)
+
+
+def _stream_page(paginator, rows):
+    """
+    Encode a PageNumberPagination envelope to JSON one row at a time.
+    
+    Produces the same document as get_paginated_response plus the JSON
+    renderer, without holding every serialized row at once.
+    """
+    yield b'{"count":' + orjson.dumps(paginator.page.paginator.count)
+    yield b',"next":' + orjson.dumps(paginator.get_next_link())
+    yield b',"previous":' + orjson.dumps(paginator.get_previous_link())
+    yield b',"results":['
+    for i, row in enumerate(rows):
+        yield (b',' if i else b'') + orjson.dumps(row)
+    yield b']}'
+
 
 class FileViewSet(viewsets.ModelViewSet):
     serializer_class = FileSerializer
+    permission_classes = [HasUserId]
+    
+    def permission_denied(self, request, message=None, code=None):
+        # A missing UserId is a malformed request rather than an auth failure,
+        # so keep answering 400 like UserIdMiddleware does
+        raise ValidationError({"detail": message or ERROR_USER_ID_REQUIRED})
+    
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # HasUserId has passed, so the user id is set; resolve it once here
+        # instead of in every action
+        self._uid = get_request_user_id(request)
+    
+    def perform_content_negotiation(self, request, force=False):
+        if self.action in _JSON_ONLY_ACTIONS:
+            return (_JSON_RENDERER, _JSON_RENDERER.media_type)
+        return super().perform_content_negotiation(request, force)
     
     def get_throttles(self):
         # Exclude delete and stats from throttling
@@ -39,21 +146,24 @@ class FileViewSet(viewsets.ModelViewSet):
         
         Returns:
             QuerySet of File objects for the requesting user
-            
-        Raises:
-            ValidationError: If UserId header is missing
         """
-        user_id = getattr(self.request, 'user_id', None)
-        if not user_id:
-            from rest_framework.exceptions import ValidationError
-            raise ValidationError({"detail": ERROR_USER_ID_REQUIRED})
-        return search_files_for_user(user_id, self.request.query_params)
+        return search_files_for_user(self._uid, self.request.query_params)
 
+    @method_decorator(condition(etag_func=_files_etag))
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
+        # Plain dicts instead of model instances; FileListSerializer renders either
+        queryset = self.get_queryset().values(*LIST_VALUE_FIELDS)
         page = self.paginate_queryset(queryset)
         if page is not None:
             serializer = self.get_serializer(page, many=True)
+            if (
+                getattr(settings, 'FILE_VAULT_STREAM_LIST_RESPONSES', False)
+                and request.accepted_renderer.format == 'json'
+            ):
+                rows = serializer.iter_values_representation(page)
+                return StreamingHttpResponse(
+                    _stream_page(self.paginator, rows), content_type='application/json'
+                )
             return self.get_paginated_response(serializer.data)
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
@@ -65,12 +175,7 @@ class FileViewSet(viewsets.ModelViewSet):
         Returns:
             200 OK with file data, or 404 if not found
         """
-        user_id = getattr(request, 'user_id', None)
-        if not user_id:
-            return Response(
-                {'detail': ERROR_USER_ID_REQUIRED}, 
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        user_id = self._uid
         instance = get_object_or_404(File, id=kwargs.get('pk'), user_id=user_id)
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
@@ -82,12 +187,7 @@ class FileViewSet(viewsets.ModelViewSet):
         Returns:
             201 Created with file data, or 400/429 on error
         """
-        user_id = getattr(request, 'user_id', None)
-        if not user_id:
-            return Response(
-                {'detail': ERROR_USER_ID_REQUIRED}, 
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        user_id = self._uid
         file_obj = request.FILES.get('file')
         if not file_obj:
             return Response(
@@ -95,6 +195,10 @@ class FileViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         new_file = handle_upload(user_id, file_obj)
+        _bump_files_version(user_id)
+        if new_file.is_reference and new_file.original_file.user_id != user_id:
+            # The original's reference_count went up in its owner's listing
+            _bump_files_version(new_file.original_file.user_id)
         serializer = self.get_serializer(new_file)
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
@@ -106,45 +210,51 @@ class FileViewSet(viewsets.ModelViewSet):
         Returns:
             204 No Content on success, or 409 if file has references
         """
-        user_id = getattr(request, 'user_id', None)
-        if not user_id:
-            return Response(
-                {'detail': ERROR_USER_ID_REQUIRED}, 
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        delete_file(user_id, kwargs.get('pk'))
+        user_id = self._uid
+        original_owner = delete_file(user_id, kwargs.get('pk'))
+        _bump_files_version(user_id)
+        if original_owner and original_owner != user_id:
+            # The original's reference_count went down in its owner's listing
+            _bump_files_version(original_owner)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=False, methods=['get'], url_path='storage_stats', throttle_classes=[])
+    @method_decorator(condition(etag_func=_files_etag))
     def storage_stats(self, request):
         """
         Get storage statistics for the requesting user.
         
+        Cached per user for STATS_CACHE_TTL_SECONDS under a versioned key so
+        dashboard polling doesn't hit the database; uploads and deletes bump
+        the version so readers move to a fresh entry.
+        
         Returns:
-            200 OK with storage statistics
+            200 OK with storage statistics, or 304 if the ETag still matches
         """
-        user_id = getattr(request, 'user_id', None)
-        if not user_id:
-            return Response(
-                {'detail': ERROR_USER_ID_REQUIRED}, 
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        data = get_storage_stats(user_id)
+        user_id = self._uid
+        key = _stats_cache_key(user_id)
+        data = cache.get(key)
+        if data is None:
+            data = get_storage_stats(user_id)
+            cache.set(key, data, STATS_CACHE_TTL_SECONDS)
         return Response(data)
 
     @action(detail=False, methods=['get'], url_path='file_types')
+    @method_decorator(condition(etag_func=_files_etag))
     def file_types(self, request):
         """
         Get distinct file types (MIME types) for the requesting user.
         
+        Cached per user for FILE_TYPES_CACHE_TTL_SECONDS under a versioned key;
+        uploads and deletes bump the version so readers move to a fresh entry.
+        
         Returns:
-            200 OK with list of file types
+            200 OK with list of file types, or 304 if the ETag still matches
         """
-        user_id = getattr(request, 'user_id', None)
-        if not user_id:
-            return Response(
-                {'detail': ERROR_USER_ID_REQUIRED}, 
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        types = distinct_file_types_for_user(user_id)
+        user_id = self._uid
+        key = _file_types_cache_key(user_id)
+        types = cache.get(key)
+        if types is None:
+            types = distinct_file_types_for_user(user_id)
+            cache.set(key, types, FILE_TYPES_CACHE_TTL_SECONDS)
         return Response(types)